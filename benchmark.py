@@ -0,0 +1,253 @@
+"""Micro-benchmarks for the hot paths of the delivery service.
+
+Run with ``python benchmark.py [name ...]``, where names are the keys of BENCHMARKS
+(all benchmarks are run if none is given).
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from models import CouriersInput, OrdersInput, minutes_mask
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:<50}{time.perf_counter() - start:>10.3f} s")
+    return result
+
+
+def make_couriers_payload(size):
+    return {'data': [{'courier_id': i,
+                      'courier_type': ('foot', 'bike', 'car')[i % 3],
+                      'regions': [i % 100, (i + 1) % 100],
+                      'working_hours': ['09:00-12:00', '14:00-18:30']} for i in range(size)]}
+
+
+def make_orders_payload(size):
+    return {'data': [{'order_id': i,
+                      'weight': 0.01 + i % 50,
+                      'region': i % 100,
+                      'delivery_hours': [f'{i % 24:02d}:00-{i % 24:02d}:59']} for i in range(size)]}
+
+
+def legacy_hours_intersect(working_h, delivery_h):
+    # Former implementation: bounds were re-parsed with strptime on every compatibility check.
+    def transform(bounds):
+        start, end = bounds.split('-')
+        return time.strptime(start, '%H:%M'), time.strptime(end, '%H:%M')
+
+    for working_h_step in working_h:
+        working_start, working_end = transform(working_h_step)
+        for delivery_h_step in delivery_h:
+            delivery_start, delivery_end = transform(delivery_h_step)
+            if max(working_start, delivery_start) < min(working_end, delivery_end):
+                return True
+    return False
+
+
+def intervals_intersect(working_h, delivery_h):
+    # Check of (start, end) minute bounds, used before minutes bitmaps.
+    for working_start, working_end in working_h:
+        for delivery_start, delivery_end in delivery_h:
+            if max(working_start, delivery_start) < min(working_end, delivery_end):
+                return True
+    return False
+
+
+def bench_validation(size=100000):
+    couriers_payload = make_couriers_payload(size)
+    orders_payload = make_orders_payload(size)
+    timed(f'CouriersInput validation, {size} items', lambda: CouriersInput(**couriers_payload))
+    orders = timed(f'OrdersInput validation, {size} items', lambda: OrdersInput(**orders_payload)).data
+    working_hours = CouriersInput(**make_couriers_payload(1)).data[0].working_hours
+    timed(f'legacy strptime compatibility checks, {size} orders',
+          lambda: [legacy_hours_intersect(working_hours, order.delivery_hours) for order in orders])
+    working_bounds = [(interval.start, interval.end) for interval in working_hours]
+    timed(f'pre-parsed compatibility checks, {size} orders',
+          lambda: [intervals_intersect(working_bounds, [(interval.start, interval.end)
+                                                        for interval in order.delivery_hours]) for order in orders])
+
+
+def bench_responses(sizes=(10000, 100000)):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['DELIVERY_DB_PATH'] = os.path.join(tmp_dir, 'sweetdelivery.db')
+        import asyncio
+        from fastapi.routing import serialize_response
+        from fastapi.testclient import TestClient
+        from main import app, FastJSONResponse, JSONResponse
+        from settings import settings
+        client = TestClient(app)
+        route = next(route for route in app.routes if route.path == '/orders')
+
+        def default_serialization(content):
+            content = asyncio.get_event_loop().run_until_complete(
+                serialize_response(field=route.secure_cloned_response_field, response_content=content))
+            return JSONResponse(content).body
+
+        for size in sizes:
+            content = {'orders': [{'id': order_id} for order_id in range(size)]}
+            timed(f'POST /orders response (default), {size} items', default_serialization, content)
+            timed(f'POST /orders response (fast), {size} items', lambda: FastJSONResponse(content).body)
+            payload = make_orders_payload(size)
+            for order in payload['data']:
+                order['weight'] = 0
+            for fast_responses in (False, True):
+                settings.fast_responses = fast_responses
+                mode = 'fast' if fast_responses else 'default'
+                timed(f'POST /orders validation error ({mode}), {size} items',
+                      lambda: client.post('/orders', json=payload))
+        settings.fast_responses = False
+
+
+def bench_bitmaps(pairs_number=1000000):
+    import random
+    random.seed(0)
+
+    def random_schedule():
+        bounds = []
+        for _ in range(random.randint(1, 3)):
+            start = random.randrange(0, 23 * 60)
+            bounds.append((start, random.randrange(start + 1, 24 * 60)))
+        return bounds
+
+    schedules = [random_schedule() for _ in range(1000)]
+    masks = []
+    for bounds in schedules:
+        mask = 0
+        for start, end in bounds:
+            mask |= minutes_mask(start, end)
+        masks.append(mask)
+    pairs = [(random.randrange(1000), random.randrange(1000)) for _ in range(pairs_number)]
+    intervals_result = timed(f'interval pairs compatibility checks, {pairs_number} pairs',
+                             lambda: [intervals_intersect(schedules[i], schedules[j]) for i, j in pairs])
+    masks_result = timed(f'bitmaps compatibility checks, {pairs_number} pairs',
+                         lambda: [bool(masks[i] & masks[j]) for i, j in pairs])
+    assert intervals_result == masks_result
+
+
+def make_database(db_path, orders_number, couriers_number=10000):
+    import sqlite3
+    from utils import DatabaseConnector
+    DatabaseConnector(db_path).conn.close()
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO couriers(id, type) VALUES (?, ?)",
+                     ((i, ('foot', 'bike', 'car')[i % 3]) for i in range(couriers_number)))
+    conn.executemany("INSERT INTO regions(region_id, courier_id) VALUES (?, ?)",
+                     ((i % 100, i) for i in range(couriers_number)))
+    conn.executemany("INSERT INTO working_hours(courier_id, working_hours, minutes_mask) "
+                     "VALUES (?, '09:00-18:00', ?)",
+                     ((i, minutes_mask(540, 1080).to_bytes(180, 'little')) for i in range(couriers_number)))
+    conn.executemany("INSERT INTO orders(order_id, weight, region, status, date_created, date_assigned, "
+                     "date_finished, courier_id, type_when_assigned) VALUES (?, ?, ?, 2, "
+                     "'2021-03-28T10:00:00.000Z', '2021-03-28T10:00:00.000Z', '2021-03-28T11:00:00.000Z', ?, 'car')",
+                     ((i, 0.01 + i % 50, i % 100, i % couriers_number) for i in range(orders_number)))
+    conn.executemany("INSERT INTO delivery_hours(order_id, delivery_hours, minutes_mask) "
+                     "VALUES (?, '10:00-12:00', ?)",
+                     ((i, minutes_mask(600, 720).to_bytes(180, 'little')) for i in range(orders_number)))
+    conn.commit()
+    conn.close()
+
+
+def bench_snapshot(orders_number=1000000):
+    from snapshot import export_snapshot, import_snapshot
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'sweetdelivery.db')
+        snapshot_path = os.path.join(tmp_dir, 'snapshot.db')
+        timed(f'building database, {orders_number} orders', make_database, db_path, orders_number)
+        timed(f'snapshot export, {orders_number} orders', export_snapshot, db_path, snapshot_path)
+        print(f"snapshot size: {os.path.getsize(snapshot_path) / 2 ** 20:.1f} MiB "
+              f"(database {os.path.getsize(db_path) / 2 ** 20:.1f} MiB)")
+        timed(f'snapshot import, {orders_number} orders',
+              import_snapshot, snapshot_path, os.path.join(tmp_dir, 'restored.db'))
+
+
+def legacy_lightest_orders(db, regions, working_hours_mask, capacity):
+    from utils import unpack_minutes_masks, unpack_orders
+    regions_tuple = str(regions)[:-2] + ')' if len(regions) == 1 else str(regions)
+    possible_orders = unpack_orders(db.cursor.execute(f"SELECT order_id, weight FROM orders "
+                                                      f"WHERE status = 0 AND region IN {regions_tuple}").fetchall())
+    delivery_time = unpack_minutes_masks(db.cursor.execute(
+        f"SELECT order_id, minutes_mask FROM delivery_hours WHERE order_id IN {tuple(possible_orders)}").fetchall())
+    orders = []
+    for order_id, weight in sorted(possible_orders.items(), key=lambda item: item[1]):
+        if working_hours_mask & delivery_time.get(order_id, 0):
+            if weight > capacity:
+                break
+            orders.append(order_id)
+            capacity -= weight
+    return orders
+
+
+def index_lightest_orders(db, regions, working_hours_mask, capacity):
+    orders = []
+    for order_id, weight in db.region_index().lightest_orders(regions, working_hours_mask):
+        if weight > capacity:
+            break
+        orders.append(order_id)
+        capacity -= weight
+    return orders
+
+
+def bench_candidates(orders_number=200000, assigns=100):
+    import sqlite3
+    from utils import DatabaseConnector
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'sweetdelivery.db')
+        make_database(db_path, orders_number)
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE orders SET status = 0, courier_id = null, date_assigned = null, date_finished = null")
+        conn.commit()
+        conn.close()
+        db = DatabaseConnector(db_path)
+        mask = minutes_mask(540, 1080)
+        regions = [(i % 100, (i + 1) % 100, (i + 2) % 100) for i in range(assigns)]
+        timed(f'region index build, {orders_number} open orders', db.region_index)
+        for label, select in (('SQL select and sort', legacy_lightest_orders),
+                              ('region index heap merge', index_lightest_orders)):
+            timed(f'{label}, {assigns} assigns of 3 regions',
+                  lambda: [select(db, courier_regions, mask, 50) for courier_regions in regions])
+        db.close()
+
+
+def bench_startup(orders_number=1000000, port=8765, timeout=60):
+    import subprocess
+    import urllib.error
+    import urllib.request
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'sweetdelivery.db')
+        make_database(db_path, orders_number)
+        for prewarm in (False, True):
+            env = dict(os.environ, DELIVERY_DB_PATH=db_path, DELIVERY_PREWARM=str(int(prewarm)))
+            start = time.perf_counter()
+            server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port)],
+                                      env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while time.perf_counter() - start < timeout:
+                    try:
+                        urllib.request.urlopen(f'http://127.0.0.1:{port}/couriers/0').read()
+                        break
+                    except (urllib.error.URLError, ConnectionError):
+                        time.sleep(0.005)
+                print(f"{f'start to first response (prewarm={prewarm}), {orders_number} orders':<50}"
+                      f"{time.perf_counter() - start:>10.3f} s")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+BENCHMARKS = {
+    'validation': bench_validation,
+    'responses': bench_responses,
+    'bitmaps': bench_bitmaps,
+    'snapshot': bench_snapshot,
+    'candidates': bench_candidates,
+    'startup': bench_startup,
+}
+
+
+if __name__ == '__main__':
+    print(f"Benchmarks started at {datetime.utcnow().isoformat()}")
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
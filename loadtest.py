@@ -0,0 +1,222 @@
+"""Load generator running a concurrent mixed workload against the delivery service.
+
+Every virtual courier is an asyncio task which sends requests one after another, like a courier app does,
+while all the couriers work concurrently. By default the app is driven in-process through httpx.ASGITransport
+on a temporary database; pass --url to load a running service instead (and --db with its database file to
+check the final state).
+
+Usage:
+    python loadtest.py [--couriers 50] [--duration 10] [--mix create=1,assign=4,complete=3,patch=1,get=2]
+
+Requires httpx (pip3 install httpx).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+COURIERS_LOAD = {'foot': 10, 'bike': 15, 'car': 50}
+REGIONS = list(range(1, 21))
+HOURS = ['08:00-10:00', '09:00-12:00', '11:30-14:00', '13:00-18:00', '17:00-21:30', '20:00-23:00']
+DEFAULT_MIX = 'create=1,assign=4,complete=3,patch=1,get=2'
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        operation, weight = item.split('=')
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{operation}'. Options are: {', '.join(OPERATIONS)}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def percentile(sorted_values, share):
+    return sorted_values[round(share * (len(sorted_values) - 1))]
+
+
+def random_courier_profile():
+    return {'courier_type': random.choice(list(COURIERS_LOAD)),
+            'regions': random.sample(REGIONS, random.randint(1, 3)),
+            'working_hours': random.sample(HOURS, random.randint(1, 2))}
+
+
+class LoadTest:
+    def __init__(self, client, couriers_number, orders_batch):
+        self.client = client
+        self.orders_batch = orders_batch
+        self.couriers = {courier_id: random_courier_profile() for courier_id in range(1, couriers_number + 1)}
+        self.next_order_id = 1
+        self.order_weights = {}
+        self.order_owners = {}  # order_id: courier_id, as seen in assign responses
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.violations = defaultdict(list)
+
+    async def request(self, operation, method, url, json=None):
+        start = time.perf_counter()
+        response = await self.client.request(method, url, json=json)
+        self.latencies[operation].append(time.perf_counter() - start)
+        self.statuses[operation][response.status_code] += 1
+        if response.status_code >= 500:
+            self.violations['server error'].append(f'{method} {url} : {response.status_code} {response.text}')
+        return response
+
+    async def create_couriers(self):
+        data = [{'courier_id': courier_id, **profile} for courier_id, profile in self.couriers.items()]
+        response = await self.client.post('/couriers', json={'data': data})
+        response.raise_for_status()
+
+    async def create(self, courier_id, own_orders):
+        data = []
+        for _ in range(self.orders_batch):
+            order_id = self.next_order_id
+            self.next_order_id += 1
+            weight = round(random.uniform(0.01, 20), 2)
+            self.order_weights[order_id] = weight
+            data.append({'order_id': order_id, 'weight': weight, 'region': random.choice(REGIONS),
+                         'delivery_hours': random.sample(HOURS, random.randint(1, 2))})
+        await self.request('create', 'POST', '/orders', {'data': data})
+
+    async def assign(self, courier_id, own_orders):
+        response = await self.request('assign', 'POST', '/orders/assign', {'courier_id': courier_id})
+        if response.status_code != 200:
+            return
+        order_ids = [order['id'] for order in response.json()['orders']]
+        for order_id in order_ids:
+            owner = self.order_owners.get(order_id)
+            if owner is not None and owner != courier_id:
+                self.violations['double assignment'].append(
+                    f'order {order_id} assigned to courier {courier_id} while held by courier {owner}')
+            self.order_owners[order_id] = courier_id
+        load = sum(self.order_weights[order_id] for order_id in order_ids)
+        courier_type = self.couriers[courier_id]['courier_type']
+        if load > COURIERS_LOAD[courier_type] + 1e-9:
+            self.violations['overweight courier'].append(
+                f'courier {courier_id} ({courier_type}) got {load:.2f} kg in orders {order_ids}')
+        if order_ids:
+            own_orders.clear()
+            own_orders.update(order_ids)
+
+    async def complete(self, courier_id, own_orders):
+        if not own_orders:
+            return await self.assign(courier_id, own_orders)
+        order_id = random.choice(sorted(own_orders))
+        own_orders.discard(order_id)
+        complete_time = f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())}.000Z"
+        response = await self.request('complete', 'POST', '/orders/complete',
+                                      {'courier_id': courier_id, 'order_id': order_id, 'complete_time': complete_time})
+        if response.status_code != 200:
+            self.violations['failed completion of an assigned order'].append(
+                f'courier {courier_id}, order {order_id} : {response.text}')
+
+    async def patch(self, courier_id, own_orders):
+        profile = random_courier_profile()
+        patch = {key: profile[key] for key in random.sample(list(profile), random.randint(1, 3))}
+        response = await self.request('patch', 'PATCH', f'/couriers/{courier_id}', patch)
+        if response.status_code == 200 or response.status_code >= 500:
+            # A failed patch is likely to have been applied partially: the profile is committed before
+            # the courier's orders are revalidated.
+            self.couriers[courier_id].update(patch)
+        # Some orders may be released by the patch, the next assign response tells which ones are kept.
+        for order_id in own_orders:
+            if self.order_owners.get(order_id) == courier_id:
+                del self.order_owners[order_id]
+        own_orders.clear()
+
+    async def get(self, courier_id, own_orders):
+        await self.request('get', 'GET', f'/couriers/{courier_id}')
+
+    async def run_courier(self, courier_id, weights, deadline):
+        own_orders = set()
+        operations, operation_weights = list(weights), list(weights.values())
+        while time.perf_counter() < deadline:
+            operation = random.choices(operations, operation_weights)[0]
+            await OPERATIONS[operation](self, courier_id, own_orders)
+            # In-process requests may complete without ever suspending, let the other couriers work.
+            await asyncio.sleep(0)
+
+    async def run(self, weights, duration):
+        await self.create_couriers()
+        start = time.perf_counter()
+        await asyncio.gather(*(self.run_courier(courier_id, weights, start + duration)
+                               for courier_id in self.couriers))
+        return time.perf_counter() - start
+
+    def check_database(self, db_path):
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            loads = conn.execute("SELECT couriers.id, couriers.type, sum(orders.weight) FROM orders "
+                                 "JOIN couriers ON couriers.id = orders.courier_id "
+                                 "WHERE orders.status = 1 GROUP BY couriers.id").fetchall()
+            for courier_id, courier_type, load in loads:
+                if load > COURIERS_LOAD[courier_type] + 1e-9:
+                    self.violations['overweight courier in database'].append(
+                        f'courier {courier_id} ({courier_type}) holds {load:.2f} kg')
+            orphans = conn.execute("SELECT count(*) FROM orders WHERE status = 1 AND courier_id IS NULL").fetchone()[0]
+            if orphans:
+                self.violations['assigned order without courier'].append(f'{orphans} orders')
+        finally:
+            conn.close()
+
+    def report(self, elapsed):
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        print(f'{total} requests in {elapsed:.2f} s, {total / elapsed:.1f} requests/s')
+        print(f"{'operation':<10}{'count':>8}{'rps':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}  statuses")
+        for operation, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            print(f'{operation:<10}{len(latencies):>8}{len(latencies) / elapsed:>9.1f}'
+                  + ''.join(f'{percentile(latencies, share) * 1000:>9.1f}' for share in (0.5, 0.9, 0.99, 1))
+                  + f'  {dict(self.statuses[operation])}')
+        if not self.violations:
+            print('No invariant violations found.')
+        for violation, examples in self.violations.items():
+            print(f'{violation}: {len(examples)}, e.g. {examples[0]}')
+
+
+OPERATIONS = {'create': LoadTest.create, 'assign': LoadTest.assign, 'complete': LoadTest.complete,
+              'patch': LoadTest.patch, 'get': LoadTest.get}
+
+
+async def main(args):
+    weights = parse_mix(args.mix)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+                                   base_url='http://loadtest',
+                                   timeout=args.timeout)
+    async with client:
+        load_test = LoadTest(client, args.couriers, args.orders_batch)
+        elapsed = await load_test.run(weights, args.duration)
+    if args.db:
+        load_test.check_database(args.db)
+    load_test.report(elapsed)
+    return load_test
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a concurrent mixed workload against the delivery service.')
+    parser.add_argument('--couriers', type=int, default=50, help='number of concurrently working couriers')
+    parser.add_argument('--duration', type=float, default=10, help='test duration, seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights, default {DEFAULT_MIX}')
+    parser.add_argument('--orders-batch', type=int, default=10, help='orders created by one create request')
+    parser.add_argument('--timeout', type=float, default=60, help='request timeout, seconds')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--url', default=None, help='URL of a running service, the app is run in-process if omitted')
+    parser.add_argument('--db', default=None, help='database file to check after the run')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not args.url:
+            # The in-process app works on a fresh database, unless told otherwise.
+            args.db = args.db or os.path.join(tmp_dir, 'sweetdelivery.db')
+            os.environ['DELIVERY_DB_PATH'] = args.db
+        asyncio.run(main(args))
@@ -1,55 +1,275 @@
-from fastapi import FastAPI, Request
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from fastapi import BackgroundTasks, FastAPI, Request, Response, WebSocket
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from models import *
-from utils import DatabaseConnector
-from sqlite3 import IntegrityError
+from notifications import AssignmentNotifier
+from profiling import ProfilingMiddleware
+from settings import settings
+from snapshot import export_snapshot
+from timeouts import RequestDeadlineMiddleware, current_deadline
+from utils import DatabaseConnector, prewarm_database
+from sqlite3 import IntegrityError, OperationalError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STALENESS_HEADER = 'x-data-staleness'  # seconds, an upper bound of how old the data of a replica response is
+started_at = time.monotonic()
 app = FastAPI()
-db = DatabaseConnector()
+app.add_middleware(ProfilingMiddleware, settings=settings)
+app.add_middleware(RequestDeadlineMiddleware, settings=settings)
+db = DatabaseConnector(settings.db_path, read_only=settings.read_only, wal=settings.wal)
+notifier = AssignmentNotifier()
+readiness = {'ready': False, 'startup_seconds': None,
+             'warmup': {'stage': 'disabled', 'completed_steps': 0, 'total_steps': 0, 'done': False}}
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str)
+
+
+class ReadOnlyReplicaMiddleware:
+    """ASGI middleware rejecting everything but GET requests when the service runs as a read-only replica."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not settings.read_only or scope['type'] == 'lifespan' or \
+                (scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD')):
+            await self.app(scope, receive, send)
+            return
+        if scope['type'] == 'websocket':
+            # Assignments are made by the primary, so a replica has nothing to notify about.
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        response = JSONResponse(status_code=405, headers={'Allow': 'GET, HEAD'},
+                                content={'messages': ['Read-only replica serves GET requests only.']})
+        await response(scope, receive, send)
+
+
+app.add_middleware(ReadOnlyReplicaMiddleware)
+
+
+def fast_responses_enabled():
+    return settings.fast_responses and orjson is not None
+
+
+def respond(content, status_code):
+    # In fast mode the content is already shaped as the response model, so validation by FastAPI is skipped.
+    if fast_responses_enabled():
+        return FastJSONResponse(content=content, status_code=status_code)
+    return content
 
 
 @app.post('/couriers', status_code=201, response_model=CouriersOutput)
 async def create_couriers(payload: CouriersInput):
     await db.insert_couriers(payload.data)
     response = {'couriers': [{'id': courier.courier_id} for courier in payload.data]}
-    return response
+    return respond(response, 201)
 
 
 @app.patch('/couriers/{courier_id}', status_code=200, response_model=Courier)
 async def patch_courier(courier_id: int, payload: PatchCourier):
     await db.patch_courier(courier_id, payload.dict(exclude_unset=True))
     response = await db.get_courier_data(courier_id)
-    return response
+    return respond(response, 200)
 
 
 @app.post('/orders', status_code=201, response_model=OrdersOutput)
-async def create_orders(payload: OrdersInput):
+async def create_orders(payload: OrdersInput, background_tasks: BackgroundTasks):
     await db.insert_orders(payload.data)
+    if notifier.courier_ids:
+        background_tasks.add_task(push_new_assignments, payload.data)
     response = {'orders': [{'id': order.order_id} for order in payload.data]}
-    return response
+    return respond(response, 201)
 
 
 @app.post('/orders/assign', status_code=200, response_model=AssignOrdersOutput, response_model_exclude_unset=True)
 async def assign_orders(payload: AssignOrdersInput):
-    orders, assign_time = await db.assign_orders_to_courier(payload.courier_id)
+    orders, assign_time, _ = await db.assign_orders_to_courier(payload.courier_id)
     orders = [{'id': order_id} for order_id in orders]
     response = {'orders': orders}
     if assign_time:
         response['assign_time'] = assign_time
-    return response
+    return respond(response, 200)
 
 
 @app.post('/orders/complete', status_code=200, response_model=OrderCompleteOutput)
 async def complete_order(payload: OrderCompleteInput):
     order_id = await db.complete_order(payload)
-    return {"order_id": order_id}
+    return respond({"order_id": order_id}, 200)
 
 
 @app.get('/couriers/{courier_id}', status_code=200, response_model=CourierInfo, response_model_exclude_unset=True)
-async def get_courier_info(courier_id):
-    return await db.calculate_couriers_rating(courier_id)
+async def get_courier_info(courier_id: int, response: Response):
+    if not settings.read_only:
+        return respond(await db.calculate_couriers_rating(courier_id), 200)
+    rating, staleness = await db.get_replica_courier_rating(courier_id, settings.replica_max_staleness)
+    response.headers[STALENESS_HEADER] = f'{staleness:.3f}'
+    result = respond(rating, 200)
+    if isinstance(result, Response):
+        result.headers[STALENESS_HEADER] = f'{staleness:.3f}'
+    return result
+
+
+@app.websocket('/couriers/{courier_id}/assignments')
+async def courier_assignments(websocket: WebSocket, courier_id: int):
+    # Every message has the format of POST /orders/assign response and is sent when new orders are assigned
+    # to the courier, so that courier apps do not need to poll POST /orders/assign.
+    queue = notifier.subscribe(courier_id)
+    receive_task = message_task = None
+    try:
+        await websocket.accept()
+        receive_task = asyncio.ensure_future(websocket.receive())
+        while True:
+            message_task = asyncio.ensure_future(queue.get())
+            await asyncio.wait({receive_task, message_task}, return_when=asyncio.FIRST_COMPLETED)
+            if message_task.done():
+                await websocket.send_json(message_task.result())
+            else:
+                message_task.cancel()
+            if receive_task.done():
+                if receive_task.result()['type'] == 'websocket.disconnect':
+                    break
+                receive_task = asyncio.ensure_future(websocket.receive())  # messages from couriers are ignored
+    finally:
+        notifier.unsubscribe(courier_id, queue)
+        # The loop may be left by a failed send, with the tasks still waiting.
+        for task in (receive_task, message_task):
+            if task is not None:
+                task.cancel()
+
+
+@app.get('/stats', status_code=200)
+async def get_stats():
+    computed, skipped = db.assign_stats['computed'], db.assign_stats['skipped']
+    return {'assign': {'computed': computed, 'skipped': skipped,
+                       'skip_rate': round(skipped / (computed + skipped), 4) if computed + skipped else None}}
+
+
+@app.get('/ready', status_code=200)
+async def get_readiness():
+    content = dict(readiness, region_index={'built': db.index.built, 'open_orders': len(db.index.orders)})
+    return JSONResponse(status_code=200 if readiness['ready'] else 503, content=content)
+
+
+def read_file_chunks(path, chunk_size=1024 * 1024):
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+@app.get('/admin/snapshot', status_code=200)
+async def get_snapshot():
+    if not settings.admin_snapshot:
+        return JSONResponse(status_code=404, content={'messages': ['Not found.']})
+    snapshot_fd, snapshot_path = tempfile.mkstemp(suffix='.db')
+    os.close(snapshot_fd)
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, export_snapshot, settings.db_path, snapshot_path)
+    except Exception:
+        os.remove(snapshot_path)
+        raise
+    filename = f"sweetdelivery-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.db"
+    return StreamingResponse(read_file_chunks(snapshot_path), media_type='application/vnd.sqlite3',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+                             background=BackgroundTask(os.remove, snapshot_path))
+
+
+# Background tasks
+
+
+async def push_new_assignments(orders: List[Order]):
+    try:
+        for courier_id in await db.find_couriers_for_orders(notifier.courier_ids, orders):
+            order_ids, assign_time, new_order_ids = await db.assign_orders_to_courier(courier_id)
+            if new_order_ids:
+                notifier.publish(courier_id, {'orders': [{'id': order_id} for order_id in order_ids],
+                                              'assign_time': assign_time})
+    except Exception as exc:
+        print(f"Pushing of new assignments failed : {exc}")
+        db.abort()
+
+
+async def archive_completed_orders_periodically():
+    older_than = timedelta(days=settings.archive_after_days)
+    while True:
+        try:
+            # Small batches with a yield in between, so that requests are served while the backlog is archived.
+            while await db.archive_completed_orders(older_than, settings.archive_batch_size) > 0:
+                await asyncio.sleep(0)
+        except Exception as exc:
+            print(f"Archiving of completed orders failed : {exc}")
+            db.conn.rollback()
+            db.mutex = False
+        await asyncio.sleep(settings.archive_interval)
+
+
+def mark_ready():
+    readiness['ready'] = True
+    readiness['startup_seconds'] = round(time.monotonic() - started_at, 3)
+    print(f"Service is ready in {readiness['startup_seconds']} s")
+
+
+async def prewarm():
+    warmup = readiness['warmup']
+    warmup.update(stage='pending', completed_steps=0, done=False)
+    warmup_started_at = time.monotonic()
+    outcome = 'done'
+    try:
+        await asyncio.wait_for(asyncio.get_event_loop().run_in_executor(None, prewarm_database, db.db_path, warmup,
+                                                                        0 if settings.read_only else 1),
+                               timeout=settings.prewarm_timeout)
+    except asyncio.TimeoutError:
+        # The worker thread finishes its current query on its own.
+        outcome = 'timed out'
+    except Exception as exc:
+        print(f"Pre-warm failed : {exc}")
+        outcome = 'failed'
+    if not settings.read_only:
+        # Built on the loop, so that no change of orders is missed; their pages are in the cache by now.
+        # It is built after a failed pre-warm too, the service is not ready without it.
+        warmup['stage'] = 'region index'
+        db.region_index()
+        warmup['completed_steps'] += 1
+    warmup['stage'] = outcome
+    warmup['done'] = True
+    warmup['seconds'] = round(time.monotonic() - warmup_started_at, 3)
+    mark_ready()
+
+
+@app.on_event('startup')
+async def start_background_tasks():
+    db.connect()
+    if settings.prewarm:
+        # The service is ready once the pre-warm and the region index build are finished.
+        app.state.prewarm_task = asyncio.ensure_future(prewarm())
+    else:
+        if not settings.read_only:
+            # Otherwise the first assignment would build the index while handling the request.
+            db.region_index()
+        mark_ready()
+    if settings.archive_after_days is not None and not settings.read_only:
+        app.state.archive_task = asyncio.ensure_future(archive_completed_orders_periodically())
+
+
+@app.on_event('shutdown')
+async def stop_background_tasks():
+    readiness['ready'] = False
+    for task_name in ('prewarm_task', 'archive_task'):
+        if getattr(app.state, task_name, None) is not None:
+            getattr(app.state, task_name).cancel()
+    db.close()
 
 # Exception handlers
 
@@ -59,17 +279,26 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     error_message = {}
     request_path = request['path'][1:]
     error_message['status_code'] = 400
+    errors = exc.errors()
     if request_path == 'couriers' or request_path == 'orders':
-        error_message_content = {'validation_error': {request_path: []}}
-        for error in exc.errors():
-            incorrect_id = \
-                {'id': exc.body['data'][error['loc'][2]]['courier_id' if request_path == 'couriers' else 'order_id']}
-            if incorrect_id not in error_message_content['validation_error'][request_path]:
-                error_message_content['validation_error'][request_path].append(incorrect_id)
-            error_message_content['message'] = list(exc.errors())
-        error_message['content'] = jsonable_encoder(error_message_content)
+        id_field = 'courier_id' if request_path == 'couriers' else 'order_id'
+        incorrect_ids = []
+        seen_ids = set()
+        for error in errors:
+            incorrect_id = exc.body['data'][error['loc'][2]][id_field]
+            try:
+                is_new = incorrect_id not in seen_ids
+                seen_ids.add(incorrect_id)
+            except TypeError:  # unhashable id sent by the client
+                is_new = {'id': incorrect_id} not in incorrect_ids
+            if is_new:
+                incorrect_ids.append({'id': incorrect_id})
+        error_message_content = {'validation_error': {request_path: incorrect_ids}, 'message': errors}
     else:
-        error_message['content'] = jsonable_encoder({"detail": exc.errors()})
+        error_message_content = {"detail": errors}
+    if fast_responses_enabled():
+        return FastJSONResponse(**error_message, content=error_message_content)
+    error_message['content'] = jsonable_encoder(error_message_content)
     return JSONResponse(**error_message)
 
 
@@ -83,13 +312,28 @@ async def value_error_handler(request: Request, exc: TypeError):
 @app.exception_handler(IntegrityError)
 async def integrity_error_handler(request: Request, exc: IntegrityError):
     print(f"{request['path']} : {exc}")
+    db.index.reset()  # the rows inserted before the error are not in the index
     error_message = {'status_code': 400, 'content': jsonable_encoder({'messages': list(exc.args)})}
     return JSONResponse(**error_message)
 
 
+@app.exception_handler(OperationalError)
+async def operational_error_handler(request: Request, exc: OperationalError):
+    print(f"{request['path']} : {exc}")
+    db.abort()  # only requests with uncommitted writes lose the caches
+    if str(exc) != 'interrupted':
+        error_message = {'status_code': 500, 'content': jsonable_encoder({'messages': 'Internal error'})}
+    elif current_deadline.get() is not None and current_deadline.get().cancelled:
+        error_message = {'status_code': 503, 'content': jsonable_encoder({'messages': ['Request was cancelled.']})}
+    else:
+        error_message = {'status_code': 504, 'content': jsonable_encoder({'messages': ['Query timeout exceeded.']})}
+    return JSONResponse(**error_message)
+
+
 @app.exception_handler(Exception)
 async def free_mutex_if_unhandled_error(request: Request, exc: Exception):
     print(f"Unhandled Exception at {request['path']} :  {exc}")
     db.mutex = False
+    db.index.reset()
     error_message = {'status_code': 500, 'content': jsonable_encoder({'messages': 'Internal error'})}
     return JSONResponse(**error_message)
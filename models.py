@@ -1,7 +1,41 @@
+import re
 from pydantic import BaseModel, validator
 from typing import List, Optional
 from datetime import datetime
 
+TIME_INTERVAL_PATTERN = re.compile(r'([01][0-9]|2[0-3]):([0-5][0-9])-([01][0-9]|2[0-3]):([0-5][0-9])')
+MINUTES_IN_DAY = 24 * 60
+
+
+def minutes_mask(start: int, end: int) -> int:
+    """Bitmap of the minutes in [start, end), bit i stands for the i-th minute of the day.
+
+    Two intervals overlap exactly when their masks have a common bit.
+    """
+    return ((1 << (end - start)) - 1) << start if end > start else 0
+
+
+class TimeInterval(str):
+    """'HH:MM-HH:MM' string which carries its bounds as minutes since midnight and its minutes bitmap."""
+
+    def __new__(cls, time_str: str, start: int, end: int):
+        interval = super().__new__(cls, time_str)
+        interval.start = start
+        interval.end = end
+        interval.mask = minutes_mask(start, end)
+        return interval
+
+
+def parse_time_intervals(time_strings: List[str]) -> List[TimeInterval]:
+    intervals = []
+    for time_str in time_strings:
+        match = TIME_INTERVAL_PATTERN.fullmatch(time_str) if isinstance(time_str, str) else None
+        if match is None:
+            raise ValueError('Time must be in HH:MM-HH:MM format.')
+        start_h, start_m, end_h, end_m = match.groups()
+        intervals.append(TimeInterval(time_str, int(start_h) * 60 + int(start_m), int(end_h) * 60 + int(end_m)))
+    return intervals
+
 
 class Courier(BaseModel):
     class Config:
@@ -21,9 +55,7 @@ class Courier(BaseModel):
 
     @validator('working_hours')
     def time_format_correctness(cls, working_hours):
-        if any(len(time_str) != 11 for time_str in working_hours):
-            raise ValueError('Time must be in HH:MM-HH:MM format.')
-        return working_hours
+        return parse_time_intervals(working_hours)
 
 
 class CouriersInput(BaseModel):
@@ -49,6 +81,10 @@ class PatchCourier(BaseModel):
     regions: Optional[List[int]] = None
     working_hours: Optional[List[str]] = None
 
+    @validator('working_hours')
+    def time_format_correctness(cls, working_hours):
+        return parse_time_intervals(working_hours) if working_hours is not None else working_hours
+
 
 class Order(BaseModel):
     class Config:
@@ -67,9 +103,7 @@ class Order(BaseModel):
 
     @validator('delivery_hours')
     def time_format_correctness(cls, delivery_hours):
-        if any(len(time_str) != 11 for time_str in delivery_hours):
-            raise ValueError('Time must be in HH:MM-HH:MM format.')
-        return delivery_hours
+        return parse_time_intervals(delivery_hours)
 
 
 class OrdersInput(BaseModel):
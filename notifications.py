@@ -0,0 +1,27 @@
+import asyncio
+from collections import defaultdict
+
+
+class AssignmentNotifier:
+    """Keeps the queues of couriers subscribed to their assignments and pushes new assignments into them."""
+    def __init__(self):
+        self.subscribers = defaultdict(dict)  # courier_id: {queue: event loop of the subscriber}
+
+    @property
+    def courier_ids(self):
+        return sorted(courier_id for courier_id, queues in self.subscribers.items() if queues)
+
+    def subscribe(self, courier_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers[courier_id][queue] = asyncio.get_event_loop()
+        return queue
+
+    def unsubscribe(self, courier_id: int, queue: asyncio.Queue):
+        self.subscribers[courier_id].pop(queue, None)
+        if not self.subscribers[courier_id]:
+            del self.subscribers[courier_id]
+
+    def publish(self, courier_id: int, message: dict):
+        for queue, loop in list(self.subscribers.get(courier_id, {}).items()):
+            # Subscribers may live in another event loop (and thread), e.g. under the test client.
+            loop.call_soon_threadsafe(queue.put_nowait, message)
@@ -0,0 +1,163 @@
+import cProfile
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+current_profile = ContextVar('current_profile', default=None)
+PROFILE_RESPONSE_HEADER = 'x-profile-stages'
+MAX_REPORTED_STATEMENTS = 20
+# Proxies commonly limit response headers to 4-8 KB: long statements (IN lists, bitmap literals) are cut, and the
+# fastest of the reported statements are dropped until the header fits.
+MAX_STATEMENT_LENGTH = 200
+MAX_HEADER_BYTES = 4000
+
+
+class RequestProfile:
+    """Per-stage timings of a single request: SQL statements with their query plans and Python stages."""
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.statements = []
+
+    def add_statement(self, sql, seconds, plan):
+        sql = ' '.join(sql.split())
+        if len(sql) > MAX_STATEMENT_LENGTH:
+            sql = sql[:MAX_STATEMENT_LENGTH] + '...'
+        statement = {'sql': sql, 'ms': seconds * 1000, 'plan': plan}
+        self.statements.append(statement)
+        return statement
+
+    def summary(self):
+        slowest = sorted(self.statements, key=lambda statement: statement['ms'], reverse=True)
+        return {'total_ms': round((time.perf_counter() - self.started_at) * 1000, 3),
+                'sql_ms': round(sum(statement['ms'] for statement in self.statements), 3),
+                'sql_statements': len(self.statements),
+                'stages_ms': {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()},
+                'slowest_statements': [dict(statement, ms=round(statement['ms'], 3))
+                                       for statement in slowest[:MAX_REPORTED_STATEMENTS]]}
+
+
+def header_summary(summary):
+    """JSON of the summary, without as many of the fastest statements as needed to fit into MAX_HEADER_BYTES.
+
+    Python-level details of such requests are in the cProfile dumps (settings.profile_dir).
+    """
+    statements = summary['slowest_statements']
+    while True:
+        if len(statements) < summary['sql_statements']:
+            summary['omitted_statements'] = summary['sql_statements'] - len(statements)
+        header = json.dumps(summary, ensure_ascii=True, separators=(',', ':'))
+        if len(header) <= MAX_HEADER_BYTES or not statements:
+            return header
+        statements.pop()
+
+
+@contextmanager
+def stage(name):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.stages[name] += time.perf_counter() - start
+
+
+class ProfilingCursor:
+    """sqlite3.Cursor wrapper which times every statement (fetching included) and gets its query plan."""
+    def __init__(self, cursor, profile: RequestProfile):
+        self.cursor = cursor
+        self.profile = profile
+        self.statement = None
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        self.cursor.execute(sql, *args)
+        seconds = time.perf_counter() - start
+        plan = None
+        if sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            # A separate cursor, so that the results of the statement are kept.
+            plan = '; '.join(row[-1] for row in self.cursor.connection.execute(f'EXPLAIN QUERY PLAN {sql}', *args))
+        self.statement = self.profile.add_statement(sql, seconds, plan)
+        return self
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def timed(self, fetch):
+        start = time.perf_counter()
+        try:
+            return fetch()
+        finally:
+            if self.statement is not None:
+                self.statement['ms'] += (time.perf_counter() - start) * 1000
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests with the profile header, or all of them if settings tell so.
+
+    The stage breakdown is returned in the x-profile-stages response header. If settings.profile_dir is set,
+    a share (settings.profile_sample_rate) of the other requests is profiled too, and every profiled request is
+    additionally run under cProfile, its stats are dumped to the directory as a .pstats file.
+    """
+    cprofile_active = False  # cProfile can not profile overlapping requests separately
+
+    def __init__(self, app, settings):
+        self.app = app
+        self.settings = settings
+
+    def is_profiled(self, scope):
+        if self.settings.profile_requests:
+            return True
+        header = self.settings.profile_header.lower().encode()
+        if any(name == header and value not in (b'', b'0') for name, value in scope['headers']):
+            return True
+        return self.settings.profile_dir is not None and random.random() < self.settings.profile_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.is_profiled(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+
+        async def send_with_profile(message):
+            if message['type'] == 'http.response.start':
+                summary = header_summary(profile.summary())
+                message['headers'] = list(message.get('headers', [])) + \
+                    [(PROFILE_RESPONSE_HEADER.encode(), summary.encode())]
+            await send(message)
+
+        profiler = None
+        if self.settings.profile_dir is not None and not ProfilingMiddleware.cprofile_active:
+            ProfilingMiddleware.cprofile_active = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            current_profile.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                ProfilingMiddleware.cprofile_active = False
+                path = scope['path'].strip('/').replace('/', '_') or 'root'
+                os.makedirs(self.settings.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(
+                    self.settings.profile_dir,
+                    f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f')}-{scope['method']}-{path}.pstats"))
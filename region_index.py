@@ -0,0 +1,71 @@
+import heapq
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+
+class RegionIndex:
+    """In-memory inverted index: region -> open (unassigned) orders sorted by weight, and region -> couriers.
+
+    It is built from the database on first use and then kept up to date by DatabaseConnector on every change of
+    open orders and courier regions, so that assignment does not have to select and sort all the open orders of
+    the courier's regions. reset() drops it, the next use rebuilds it from the database.
+    """
+    def __init__(self):
+        self.built = False
+        self.orders = {}  # order_id: (region, weight, delivery minutes mask) of open orders
+        self.region_orders = defaultdict(list)  # region: sorted [(weight, order_id)] of open orders
+        self.region_couriers = defaultdict(set)
+        self.courier_regions = {}
+
+    def reset(self):
+        self.built = False
+        self.orders.clear()
+        self.region_orders.clear()
+        self.region_couriers.clear()
+        self.courier_regions.clear()
+
+    def build(self, open_orders, orders_masks, couriers_regions):
+        """open_orders are (order_id, weight, region) rows, couriers_regions are (courier_id, region_id) rows."""
+        self.reset()
+        for order_id, weight, region in open_orders:
+            self.orders[order_id] = (region, weight, orders_masks.get(order_id, 0))
+            self.region_orders[region].append((weight, order_id))
+        for region_orders in self.region_orders.values():
+            region_orders.sort()
+        for courier_id, region in couriers_regions:
+            self.region_couriers[region].add(courier_id)
+            self.courier_regions.setdefault(courier_id, set()).add(region)
+        self.built = True
+
+    def add_order(self, order_id, weight, region, mask):
+        if not self.built:
+            return
+        self.orders[order_id] = (region, weight, mask)
+        insort(self.region_orders[region], (weight, order_id))
+
+    def remove_orders(self, order_ids):
+        if not self.built:
+            return
+        for order_id in order_ids:
+            region, weight, _ = self.orders.pop(order_id)
+            region_orders = self.region_orders[region]
+            del region_orders[bisect_left(region_orders, (weight, order_id))]
+
+    def set_courier_regions(self, courier_id, regions):
+        if not self.built:
+            return
+        for region in self.courier_regions.pop(courier_id, ()):
+            self.region_couriers[region].discard(courier_id)
+        for region in regions:
+            self.region_couriers[region].add(courier_id)
+        self.courier_regions[courier_id] = set(regions)
+
+    def lightest_orders(self, regions, working_hours_mask):
+        """Yields (order_id, weight) of the open orders in the regions deliverable during the working hours,
+        lightest first (orders of the same weight by id)."""
+        for weight, order_id in heapq.merge(*(self.region_orders.get(region, ()) for region in set(regions))):
+            if working_hours_mask & self.orders[order_id][2]:
+                yield order_id, weight
+
+    def couriers_in(self, regions):
+        return {courier_id for region in regions for courier_id in self.region_couriers.get(region, ())}
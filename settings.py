@@ -0,0 +1,41 @@
+from typing import Dict, Optional
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """Service settings, read from environment variables with the DELIVERY_ prefix (e.g. DELIVERY_DB_PATH)."""
+    class Config:
+        env_prefix = 'DELIVERY_'
+
+    db_path: str = 'sweetdelivery.db'
+    # Build responses directly and serialize them with orjson, skipping response_model re-validation.
+    fast_responses: bool = False
+    # GET /admin/snapshot serves a full copy of the database without authentication, so it is off by default.
+    admin_snapshot: bool = False
+    # Completed orders older than this number of days are moved to the archive table, None disables archiving.
+    archive_after_days: Optional[float] = None
+    archive_batch_size: int = 1000
+    archive_interval: float = 60.0
+    # Read the hot tables in background after startup, so that first requests do not wait for the disk.
+    prewarm: bool = False
+    prewarm_timeout: float = 30.0
+    # Per-stage timings of a request (SQL statements with query plans, Python stages) are returned in the
+    # x-profile-stages response header for requests with the profile header, or for all requests if profile_requests.
+    profile_requests: bool = False
+    profile_header: str = 'x-profile'
+    # If set, profiled requests and a sample of the other ones are also run under cProfile, stats are dumped here.
+    profile_dir: Optional[str] = None
+    profile_sample_rate: float = 0.0
+    # Read-only replica: the database is opened with a mode=ro URI and only GET endpoints are served. The primary
+    # should run with wal, so that the replica reads do not block its writes.
+    read_only: bool = False
+    wal: bool = False
+    # A replica serves a cached rating for this number of seconds after the database has changed.
+    replica_max_staleness: float = 1.0
+    # Queries of a request running for longer than this number of seconds are interrupted and the request answers 504.
+    # query_timeouts overrides it per endpoint by the longest 'METHOD /path' prefix, e.g. {"GET /couriers": 2}.
+    query_timeout: Optional[float] = None
+    query_timeouts: Dict[str, float] = {}
+
+
+settings = Settings()
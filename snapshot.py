@@ -0,0 +1,85 @@
+"""Consistent snapshots of the service database, made with the SQLite online backup API.
+
+Usage:
+    python snapshot.py export <snapshot file> [--db sweetdelivery.db]
+    python snapshot.py import <snapshot file> [--db sweetdelivery.db]
+
+Export can be run while the service is working. Stop the service before import: the whole
+database is replaced with the snapshot contents.
+"""
+import argparse
+import sqlite3
+import time
+from settings import settings
+
+REQUIRED_TABLES = {'couriers', 'regions', 'working_hours', 'delivery_hours', 'orders'}
+EXPORT_STEP_PAGES = 1024
+EXPORT_STEP_PAUSE = 0.005  # seconds between the steps, the service commits meanwhile
+EXPORT_MAX_RESTARTS = 10
+EXPORT_BUSY_RETRY_PAUSE = 0.01  # seconds to wait for a commit of the service to finish before the next step
+
+
+class ExportRestartsExceeded(Exception):
+    pass
+
+
+def export_snapshot(db_path: str, snapshot_path: str, step_pages=EXPORT_STEP_PAGES, step_pause=EXPORT_STEP_PAUSE,
+                    max_restarts=EXPORT_MAX_RESTARTS):
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(snapshot_path)
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # Readers do not block writers in WAL mode, so all pages are copied from a single read snapshot.
+            source.backup(target, pages=-1)
+        else:
+            # Otherwise a read lock blocks the commits of the service, so it is held for one step of step_pages
+            # pages at a time. A commit of the service between the steps restarts the copy from the first page,
+            # so the snapshot is still consistent. A busy service may keep restarting it though: after max_restarts
+            # the whole database is copied in a single step, the commits wait for it.
+            progress = {'remaining': None, 'restarts': 0}
+
+            def pause_between_steps(status, remaining, total):
+                if progress['remaining'] is not None and remaining > progress['remaining']:
+                    progress['restarts'] += 1
+                    if progress['restarts'] > max_restarts:
+                        raise ExportRestartsExceeded()
+                progress['remaining'] = remaining
+                time.sleep(step_pause)
+
+            try:
+                source.backup(target, pages=step_pages, progress=pause_between_steps, sleep=EXPORT_BUSY_RETRY_PAUSE)
+            except ExportRestartsExceeded:
+                source.backup(target, pages=-1, sleep=EXPORT_BUSY_RETRY_PAUSE)
+        # The snapshot is a private copy, so it can be compacted without blocking the service.
+        target.execute('VACUUM')
+    finally:
+        target.close()
+        source.close()
+
+
+def import_snapshot(snapshot_path: str, db_path: str):
+    source = sqlite3.connect(f'file:{snapshot_path}?mode=ro', uri=True)
+    try:
+        tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+        if not REQUIRED_TABLES <= tables:
+            raise ValueError(f"'{snapshot_path}' is not a snapshot, missing tables: "
+                             f"{', '.join(sorted(REQUIRED_TABLES - tables))}")
+        target = sqlite3.connect(db_path)
+        try:
+            source.backup(target, pages=-1)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import a snapshot of the delivery service database.')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('snapshot', help='path to the snapshot file')
+    parser.add_argument('--db', default=settings.db_path, help='path to the service database')
+    args = parser.parse_args()
+    if args.action == 'export':
+        export_snapshot(args.db, args.snapshot)
+    else:
+        import_snapshot(args.snapshot, args.db)
@@ -1,8 +1,20 @@
+import asyncio
+import json
 import os
+import sqlite3
+import threading
+import time
 import datetime
+import main
+import pytest
 from fastapi.testclient import TestClient
-from main import app
-from utils import DATETIME_FORMAT
+from main import app, db, notifier
+from models import OrdersInput
+from settings import settings
+from snapshot import export_snapshot, import_snapshot
+from starlette.websockets import WebSocketDisconnect
+from timeouts import RequestDeadline, current_deadline
+from utils import DATETIME_FORMAT, DatabaseConnector
 
 client = TestClient(app)
 
@@ -76,6 +88,37 @@ def test_add_couriers_incorrect():
                                            'type': 'value_error'}]
 
 
+def test_add_couriers_incorrect_time():
+    json_couriers = \
+        {
+            "data": [
+                {
+                    "courier_id": 4,
+                    "courier_type": "foot",
+                    "regions": [1],
+                    "working_hours": ["25:00-26:00"]
+                },
+                {
+                    "courier_id": 5,
+                    "courier_type": "bike",
+                    "regions": [22],
+                    "working_hours": ["09:00/18:00"],
+                },
+                {
+                    "courier_id": 6,
+                    "courier_type": "car",
+                    "regions": [12],
+                    "working_hours": ["09:00-18:00", "9:00-18:000"]
+                },
+
+            ]
+        }
+    response = client.post('/couriers', json=json_couriers)
+    assert response.status_code == 400
+    assert response.json()['validation_error'] == {'couriers': [{'id': 4}, {'id': 5}, {'id': 6}]}
+    assert all(error['msg'] == 'Time must be in HH:MM-HH:MM format.' for error in response.json()['message'])
+
+
 def test_add_orders_correct():
     json_orders = \
         {
@@ -347,6 +390,460 @@ def test_courier_rating():
     assert response.json()['rating'] is not None
 
 
+def test_archive_completed_orders():
+    rating_before = client.get('/couriers/2').json()
+    completed_ids = db.cursor.execute("SELECT order_id FROM orders WHERE status = 2").fetchall()
+    assert db.cursor.execute("SELECT count(*) FROM delivery_hours "
+                             "WHERE order_id IN (SELECT order_id FROM orders WHERE status = 2)").fetchone()[0] > 0
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(db.archive_completed_orders(datetime.timedelta(0), batch_size=2)) == 2
+    assert loop.run_until_complete(db.archive_completed_orders(datetime.timedelta(0), batch_size=2)) == 1
+    assert loop.run_until_complete(db.archive_completed_orders(datetime.timedelta(0), batch_size=2)) == 0
+    assert db.cursor.execute("SELECT count(*) FROM orders WHERE status = 2").fetchone()[0] == 0
+    archived_ids = db.cursor.execute("SELECT order_id FROM orders_archive").fetchall()
+    assert sorted(archived_ids) == sorted(completed_ids)
+    assert db.cursor.execute("SELECT count(*) FROM delivery_hours "
+                             "WHERE order_id IN (SELECT order_id FROM orders_archive)").fetchone()[0] == 0
+    assert client.get('/couriers/2').json() == rating_before
+
+    json_complete = \
+        {
+            "courier_id": 2,
+            "order_id": 3,
+            "complete_time": datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
+        }
+    response = client.post('/orders/complete', json=json_complete)
+    assert response.status_code == 400
+    assert response.json() == {'messages': ['Order with id 3 was already completed.']}
+    json_orders = {"data": [{"order_id": 3, "weight": 1, "region": 22, "delivery_hours": ["09:00-18:00"]}]}
+    response = client.post('/orders', json=json_orders)
+    assert response.status_code == 400
+    assert response.json() == {'messages': ['Order with id = 3 already exists']}
+
+
+def test_rating_without_completed_orders_in_current_regions():
+    json_couriers = {"data": [{"courier_id": 40, "courier_type": "foot", "regions": [40],
+                               "working_hours": ["09:00-18:00"]}]}
+    client.post('/couriers', json=json_couriers)
+    json_orders = {"data": [{"order_id": 40, "weight": 1, "region": 40, "delivery_hours": ["09:00-18:00"]}]}
+    client.post('/orders', json=json_orders)
+    assert client.post('/orders/assign', json={"courier_id": 40}).json()['orders'] == [{'id': 40}]
+    json_complete = \
+        {
+            "courier_id": 40,
+            "order_id": 40,
+            "complete_time": datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
+        }
+    assert client.post('/orders/complete', json=json_complete).status_code == 200
+    client.patch('/couriers/40', json={"regions": [41]})
+    # The only completed order is in a region the courier does not work in anymore: no rating, but earnings.
+    response = client.get('/couriers/40')
+    assert response.status_code == 200
+    assert response.json() == {'courier_id': 40,
+                               'courier_type': 'foot',
+                               'regions': [41],
+                               'working_hours': ['09:00-18:00'],
+                               'earnings': 1000}
+
+
+def test_snapshot(tmp_path):
+    assert client.get('/admin/snapshot').status_code == 404
+    settings.admin_snapshot = True
+    try:
+        response = client.get('/admin/snapshot')
+    finally:
+        settings.admin_snapshot = False
+    assert response.status_code == 200
+    snapshot_path = tmp_path / 'snapshot.db'
+    snapshot_path.write_bytes(response.content)
+    restored_path = tmp_path / 'restored.db'
+    import_snapshot(str(snapshot_path), str(restored_path))
+    restored = sqlite3.connect(str(restored_path))
+    for table in ('couriers', 'regions', 'working_hours', 'delivery_hours', 'orders', 'orders_archive'):
+        query = f"SELECT * FROM {table} ORDER BY rowid"
+        assert restored.execute(query).fetchall() == db.cursor.execute(query).fetchall()
+    restored.close()
+
+    # Copied page by page, as a database in the rollback journal mode is.
+    export_snapshot(db.db_path, str(snapshot_path) + '.stepped', step_pages=1, step_pause=0)
+    stepped = sqlite3.connect(str(snapshot_path) + '.stepped')
+    for table in ('couriers', 'regions', 'working_hours', 'delivery_hours', 'orders', 'orders_archive'):
+        query = f"SELECT * FROM {table} ORDER BY rowid"
+        assert stepped.execute(query).fetchall() == db.cursor.execute(query).fetchall()
+    stepped.close()
+
+    # Commits between the steps restart the copy, after max_restarts the database is copied at once.
+    busy_path = str(tmp_path / 'busy.db')
+    import_snapshot(str(snapshot_path), busy_path)
+    writing = threading.Event()
+    writing.set()
+
+    def write_continuously():
+        conn = sqlite3.connect(busy_path, timeout=10)
+        while writing.is_set():
+            conn.execute("INSERT INTO regions(region_id, courier_id) VALUES (1000, 1000)")
+            conn.commit()
+            time.sleep(0.001)
+        conn.close()
+
+    writer = threading.Thread(target=write_continuously)
+    writer.start()
+    try:
+        start = time.monotonic()
+        export_snapshot(busy_path, str(tmp_path / 'busy-snapshot.db'), step_pages=1, step_pause=0.001, max_restarts=0)
+        assert time.monotonic() - start < 10
+    finally:
+        writing.clear()
+        writer.join()
+    busy_snapshot = sqlite3.connect(str(tmp_path / 'busy-snapshot.db'))
+    assert busy_snapshot.execute("SELECT count(*) FROM couriers").fetchone() == \
+        db.cursor.execute("SELECT count(*) FROM couriers").fetchone()
+    busy_snapshot.close()
+
+
+def test_fast_responses():
+    json_couriers = {"data": [{"courier_id": 7, "courier_type": "foot", "regions": [1], "working_hours": []}]}
+    json_orders = {"data": [{"order_id": 7, "weight": 100, "region": 1, "delivery_hours": ["09:00-18:00"]},
+                            {"order_id": 7, "weight": 0.001, "region": 1, "delivery_hours": ["09:00-18:00"]}]}
+    slow_error = client.post('/orders', json=json_orders)
+    slow_rating = client.get('/couriers/2').json()
+    slow_patch = client.patch('/couriers/2', json={'regions': [12, 22]}).json()
+    settings.fast_responses = True
+    try:
+        response = client.post('/couriers', json=json_couriers)
+        assert response.status_code == 201
+        assert response.json() == {'couriers': [{'id': 7}]}
+        response = client.get('/couriers/2')
+        assert response.status_code == 200
+        assert response.json()['earnings'] == 2500
+        assert response.json() == slow_rating
+        assert client.patch('/couriers/2', json={'regions': [12, 22]}).json() == slow_patch
+        fast_error = client.post('/orders', json=json_orders)
+        assert fast_error.status_code == 400
+        assert fast_error.json() == slow_error.json()
+        assert fast_error.json()['validation_error'] == {'orders': [{'id': 7}]}
+    finally:
+        settings.fast_responses = False
+
+
+def test_assignment_notifications():
+    json_couriers = {"data": [{"courier_id": 8, "courier_type": "foot", "regions": [98, 99],
+                               "working_hours": ["09:00-12:00"]}]}
+    client.post('/couriers', json=json_couriers)
+    json_orders = \
+        {
+            "data": [
+                {"order_id": 20, "weight": 11, "region": 99, "delivery_hours": ["09:00-10:00"]},
+                {"order_id": 21, "weight": 1, "region": 99, "delivery_hours": ["12:00-14:00"]},
+                {"order_id": 22, "weight": 1, "region": 97, "delivery_hours": ["09:00-10:00"]},
+                {"order_id": 23, "weight": 2, "region": 98, "delivery_hours": ["11:00-14:00"]},
+                {"order_id": 24, "weight": 3, "region": 99, "delivery_hours": ["07:00-09:30"]},
+            ]
+        }
+    with client.websocket_connect('/couriers/8/assignments') as websocket:
+        response = client.post('/orders', json=json_orders)
+        assert response.status_code == 201
+        message = websocket.receive_json()
+        assert message['orders'] == [{'id': 23}, {'id': 24}]
+        assert 'assign_time' in message
+    assert notifier.courier_ids == []
+    assigned = db.cursor.execute("SELECT order_id FROM orders WHERE courier_id = 8 AND status = 1").fetchall()
+    assert sorted(assigned) == [(23,), (24,)]
+
+
+class BrokenWebSocket:
+    """WebSocket of a courier app which has gone: sending fails, nothing is ever received."""
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        await asyncio.Event().wait()
+
+    async def send_json(self, message):
+        raise RuntimeError('Connection is closed.')
+
+
+def test_assignment_notifications_failed_send():
+    async def run():
+        subscription = asyncio.ensure_future(main.courier_assignments(BrokenWebSocket(), 41))
+        await asyncio.sleep(0)
+        notifier.publish(41, {'orders': [], 'assign_time': None})
+        with pytest.raises(RuntimeError):
+            await subscription
+        await asyncio.sleep(0)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
+    assert notifier.courier_ids == []
+
+
+def test_assign_skips_unchanged():
+    stats = client.get('/stats').json()['assign']
+    response = client.post('/orders/assign', json={"courier_id": 8})
+    assert response.status_code == 200
+    assert response.json()['orders'] == [{'id': 23}, {'id': 24}]
+    assert client.post('/orders/assign', json={"courier_id": 8}).json() == response.json()
+    new_stats = client.get('/stats').json()['assign']
+    assert new_stats['skipped'] == stats['skipped'] + 2
+    assert new_stats['computed'] == stats['computed']
+
+    json_orders = {"data": [{"order_id": 25, "weight": 1, "region": 98, "delivery_hours": ["09:00-10:00"]}]}
+    client.post('/orders', json=json_orders)
+    response = client.post('/orders/assign', json={"courier_id": 8})
+    assert response.json()['orders'] == [{'id': 23}, {'id': 24}, {'id': 25}]
+    json_complete = \
+        {
+            "courier_id": 8,
+            "order_id": 23,
+            "complete_time": datetime.datetime.utcnow().isoformat()[:-3] + 'Z'
+        }
+    client.post('/orders/complete', json=json_complete)
+    response = client.post('/orders/assign', json={"courier_id": 8})
+    assert response.json()['orders'] == [{'id': 24}, {'id': 25}]
+    assert client.get('/stats').json()['assign']['computed'] == stats['computed'] + 2
+
+
+class LockedConnection:
+    """Connection whose commits fail, like they do when the database is locked for too long."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def commit(self):
+        raise sqlite3.OperationalError('database is locked')
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_failed_push_is_rolled_back():
+    client.post('/couriers', json={"data": [{"courier_id": 9, "courier_type": "foot", "regions": [96],
+                                             "working_hours": ["09:00-12:00"]}]})
+    json_orders = {"data": [{"order_id": 90, "weight": 1, "region": 96, "delivery_hours": ["09:00-10:00"]}]}
+    assert client.post('/orders', json=json_orders).status_code == 201
+
+    async def push():
+        queue = notifier.subscribe(9)
+        try:
+            await main.push_new_assignments(OrdersInput(**json_orders).data)
+        finally:
+            notifier.unsubscribe(9, queue)
+        return queue
+
+    conn = db.conn
+    db._conn = LockedConnection(conn)
+    try:
+        queue = asyncio.run(push())
+    finally:
+        db._conn = conn
+    assert queue.empty()
+    assert db.mutex is False
+    assert db.cursor.execute("SELECT status, courier_id FROM orders WHERE order_id = 90").fetchone() == (0, None)
+    assert 90 in db.region_index().orders
+    response = client.post('/orders/assign', json={"courier_id": 9})
+    assert response.json()['orders'] == [{'id': 90}]
+
+
+def test_profiling(tmp_path):
+    response = client.get('/couriers/2')
+    assert 'x-profile-stages' not in response.headers
+    response = client.get('/couriers/2', headers={'x-profile': '1'})
+    assert response.status_code == 200
+    profile = json.loads(response.headers['x-profile-stages'])
+    assert profile['sql_statements'] == len(profile['slowest_statements']) > 0
+    assert {'strptime', 'earnings loop', 'rating loop'} <= set(profile['stages_ms'])
+    assert all(statement['plan'] for statement in profile['slowest_statements'])
+
+    # Statements of big batches are cut and the header stays within common proxy limits.
+    json_orders = {"data": [{"order_id": order_id, "weight": 1, "region": 500, "delivery_hours": ["09:00-10:00"]}
+                            for order_id in range(300, 499)]}
+    response = client.post('/orders', json=json_orders, headers={'x-profile': '1'})
+    assert response.status_code == 201
+    assert len(response.headers['x-profile-stages']) <= 4000
+    profile = json.loads(response.headers['x-profile-stages'])
+    assert profile['sql_statements'] == len(profile['slowest_statements']) + profile['omitted_statements']
+    assert all(len(statement['sql']) <= 203 for statement in profile['slowest_statements'])
+
+    settings.profile_dir = str(tmp_path)
+    try:
+        client.get('/couriers/2', headers={'x-profile': '1'})
+    finally:
+        settings.profile_dir = None
+    assert [path.suffix for path in tmp_path.iterdir()] == ['.pstats']
+
+
+def test_readiness(monkeypatch):
+    assert client.get('/ready').status_code == 503
+    settings.prewarm = True
+    db.index.reset()
+    prewarm_database = main.prewarm_database
+    warmup_allowed = threading.Event()
+
+    def slow_prewarm_database(*args):
+        warmup_allowed.wait(5)
+        prewarm_database(*args)
+
+    monkeypatch.setattr(main, 'prewarm_database', slow_prewarm_database)
+    try:
+        with TestClient(app) as started_client:
+            # Not ready until the pre-warm and the region index build are finished.
+            response = started_client.get('/ready')
+            assert response.status_code == 503
+            assert response.json()['warmup']['done'] is False
+            assert response.json()['region_index']['built'] is False
+            warmup_allowed.set()
+            for _ in range(100):
+                response = started_client.get('/ready')
+                if response.json()['warmup']['done']:
+                    break
+                time.sleep(0.01)
+            assert response.status_code == 200
+            assert response.json()['ready'] is True
+            assert response.json()['startup_seconds'] is not None
+            warmup = response.json()['warmup']
+            assert warmup['stage'] == 'done'
+            assert warmup['completed_steps'] == warmup['total_steps'] > 0
+            assert response.json()['region_index']['built'] is True
+    finally:
+        warmup_allowed.set()
+        settings.prewarm = False
+    assert client.get('/couriers/2').status_code == 200
+
+
+def test_read_only_replica():
+    expected = client.get('/couriers/2').json()
+    replica = DatabaseConnector(db.db_path, read_only=True)
+    settings.read_only, main.db = True, replica
+    try:
+        response = client.post('/orders', json={'data': []})
+        assert response.status_code == 405
+        assert response.json() == {'messages': ['Read-only replica serves GET requests only.']}
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect('/couriers/2/assignments'):
+                pass
+
+        response = client.get('/couriers/2')
+        assert response.status_code == 200
+        assert response.json() == expected
+        assert response.headers['x-data-staleness'] == '0.000'
+
+        # A commit of the primary is seen by the replica only after replica_max_staleness.
+        db.cursor.execute("INSERT INTO regions (region_id, courier_id) VALUES (99, 2)")
+        db.conn.commit()
+        settings.replica_max_staleness = 60
+        response = client.get('/couriers/2')
+        assert response.json() == expected
+        assert float(response.headers['x-data-staleness']) >= 0
+        settings.replica_max_staleness = 0
+        response = client.get('/couriers/2')
+        assert response.json()['regions'] == expected['regions'] + [99]
+        assert response.headers['x-data-staleness'] == '0.000'
+    finally:
+        settings.read_only, settings.replica_max_staleness, main.db = False, 1.0, db
+        replica.close()
+        db.cursor.execute("DELETE FROM regions WHERE region_id = 99 AND courier_id = 2")
+        db.conn.commit()
+    assert client.post('/orders', json={'data': []}).status_code == 201
+
+
+def test_region_index():
+    index = db.region_index()
+    maintained = (dict(index.orders), {region: orders for region, orders in index.region_orders.items() if orders},
+                  {region: couriers for region, couriers in index.region_couriers.items() if couriers})
+    index.reset()
+    index = db.region_index()
+    rebuilt = (dict(index.orders), {region: orders for region, orders in index.region_orders.items() if orders},
+               {region: couriers for region, couriers in index.region_couriers.items() if couriers})
+    assert maintained == rebuilt
+    assert all(orders == sorted(orders) for orders in index.region_orders.values())
+
+
+def test_query_timeouts(tmp_path):
+    client.post('/orders/assign', json={"courier_id": 9})
+    assignments = dict(db.assignments)
+    assert db.region_index().built and assignments
+    settings.query_timeouts = {'GET /couriers': 0, 'GET /couriers/3': 60}
+    try:
+        response = client.get('/couriers/2')
+        assert response.status_code == 504
+        assert response.json() == {'messages': ['Query timeout exceeded.']}
+        assert client.get('/couriers/3').status_code == 200
+    finally:
+        settings.query_timeouts = {}
+    assert client.get('/couriers/2').status_code == 200
+    assert db.mutex is False
+    # A failed read leaves nothing to roll back, the caches are kept.
+    assert db.index.built and db.assignments == assignments
+
+    endless_query = "WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers) " \
+                    "SELECT count(*) FROM numbers"
+
+    async def run_query(connector, deadline, cancel_after=None):
+        current_deadline.set(deadline)
+        if cancel_after is not None:
+            asyncio.get_event_loop().call_later(cancel_after, deadline.cancel)
+        return await connector.fetchall(endless_query)
+
+    # Without WAL the query runs on the main connection, so the deadline interrupts it.
+    start = time.monotonic()
+    with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+        asyncio.run(run_query(db, RequestDeadline(0.05)))
+    assert time.monotonic() - start < 5
+    assert db._reader is None
+    assert asyncio.run(db.fetchall("SELECT count(*) FROM couriers"))[0][0] > 0
+
+    # With WAL it runs in the reader thread, and is interrupted by a disconnect too.
+    wal_db = DatabaseConnector(str(tmp_path / 'wal.db'), wal=True)
+    try:
+        start = time.monotonic()
+        with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+            asyncio.run(run_query(wal_db, RequestDeadline(0.05)))
+        with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+            asyncio.run(run_query(wal_db, RequestDeadline(), cancel_after=0.05))
+        assert time.monotonic() - start < 5
+        assert wal_db._reader is not None
+        assert asyncio.run(wal_db.fetchall("SELECT count(*) FROM couriers")) == [(0,)]
+    finally:
+        wal_db.close()
+
+    # Queries on the main connection are checked by the progress handler.
+    token = current_deadline.set(RequestDeadline(0.05))
+    try:
+        with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+            db.cursor.execute(endless_query).fetchall()
+    finally:
+        current_deadline.reset(token)
+
+
+def test_slow_read_does_not_block_writes(tmp_path):
+    slow_query = "WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers) " \
+                 "SELECT count(*) FROM numbers"
+    for wal in (False, True):
+        connector = DatabaseConnector(str(tmp_path / f'wal-{wal}.db'), wal=wal)
+
+        async def read_and_write():
+            async def slow_read():
+                current_deadline.set(RequestDeadline(0.3))
+                return await connector.fetchall(slow_query)
+
+            read = asyncio.ensure_future(slow_read())
+            await asyncio.sleep(0.05)
+            # With WAL the read is still running in the reader thread, otherwise it has run on the loop.
+            assert read.done() is not wal
+            start = time.monotonic()
+            connector.cursor.execute("INSERT INTO regions(region_id, courier_id) VALUES (1, 1)")
+            connector.conn.commit()
+            write_seconds = time.monotonic() - start
+            with pytest.raises(sqlite3.OperationalError, match='interrupted'):
+                await read
+            return write_seconds
+
+        try:
+            assert asyncio.run(read_and_write()) < 0.2
+            assert connector.cursor.execute("SELECT count(*) FROM regions").fetchone() == (1,)
+        finally:
+            connector.close()
+
+
 def test_remove_database():
     os.remove(f"{os.getcwd()}/sweetdelivery.db")
     assert not os.path.isfile(f"{os.getcwd()}/sweetdelivery.db")
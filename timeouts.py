@@ -0,0 +1,97 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from sqlite3 import OperationalError
+
+current_deadline = ContextVar('current_deadline', default=None)
+PROGRESS_HANDLER_INSTRUCTIONS = 1000  # SQLite virtual machine instructions between deadline checks
+
+
+class RequestDeadline:
+    """Time by which the queries of a request have to finish, and whether the client is still waiting for them."""
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.cancelled = False  # the client has disconnected
+        self.finished = False  # the response is sent, background tasks are not limited
+        self.cancel_callbacks = set()
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def cancel(self):
+        self.cancelled = True
+        if not self.finished:
+            for callback in list(self.cancel_callbacks):
+                callback()
+
+    def expired(self):
+        if self.finished:
+            return False
+        return self.cancelled or (self.deadline is not None and time.monotonic() > self.deadline)
+
+
+def interrupt_expired_query():
+    """SQLite progress handler, a non-zero result interrupts the query with OperationalError('interrupted')."""
+    deadline = current_deadline.get()
+    return int(deadline is not None and deadline.expired())
+
+
+def check_deadline():
+    if interrupt_expired_query():
+        raise OperationalError('interrupted')
+
+
+class RequestDeadlineMiddleware:
+    """ASGI middleware giving every request a RequestDeadline, which is checked by the database queries.
+
+    The timeout is taken from settings.query_timeouts by the longest 'METHOD /path' prefix of the request, or is
+    settings.query_timeout. The request is cancelled as soon as the client disconnects before the response is sent.
+    """
+    def __init__(self, app, settings):
+        self.app = app
+        self.settings = settings
+
+    def timeout(self, method, path):
+        timeout, matched = self.settings.query_timeout, ''
+        for key, key_timeout in self.settings.query_timeouts.items():
+            key_method, _, key_path = key.partition(' ')
+            key_path = key_path.rstrip('/')
+            if key_method == method and (path == key_path or path.startswith(key_path + '/')) and \
+                    len(key_path) >= len(matched):
+                timeout, matched = key_timeout, key_path
+        return timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        deadline = RequestDeadline(self.timeout(scope['method'], scope['path']))
+        token = current_deadline.set(deadline)
+        # The client messages are read in background, so that a disconnect is noticed while the app is working.
+        messages = asyncio.Queue()
+
+        async def watch_client():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message['type'] == 'http.disconnect':
+                    deadline.cancel()
+                    return
+
+        async def receive_message():
+            message = await messages.get()
+            if message['type'] == 'http.disconnect':
+                messages.put_nowait(message)  # every next receive gets the disconnect too
+            return message
+
+        async def send_message(message):
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                deadline.finished = True
+            await send(message)
+
+        watcher = asyncio.ensure_future(watch_client())
+        try:
+            await self.app(scope, receive_message, send_message)
+        finally:
+            watcher.cancel()
+            current_deadline.reset(token)
@@ -1,8 +1,16 @@
 import asyncio
+import contextvars
 import sqlite3
+import threading
 import time
 from models import *
+from profiling import ProfilingCursor, current_profile, stage
+from region_index import RegionIndex
+from timeouts import PROGRESS_HANDLER_INSTRUCTIONS, check_deadline, current_deadline, interrupt_expired_query
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+from datetime import timedelta
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
@@ -15,14 +23,15 @@ def unpack_list_to_list(nested_list):
     return list(chain.from_iterable(nested_list))
 
 
-def unpack_delivery_hours(nested_list):
+def mask_to_sql(mask: int) -> str:
+    return f"X'{mask.to_bytes(MINUTES_IN_DAY // 8, 'little').hex()}'"
+
+
+def unpack_minutes_masks(nested_list):
+    # Rows of (owner_id, mask of one time interval) to {owner_id: mask of all his time intervals}.
     result_dict = {}
-    for item in nested_list:
-        order_id, delivery_hours = item
-        if order_id not in list(result_dict.keys()):
-            result_dict[order_id] = [delivery_hours]
-        else:
-            result_dict[order_id].append(delivery_hours)
+    for owner_id, mask in nested_list:
+        result_dict[owner_id] = result_dict.get(owner_id, 0) | int.from_bytes(mask or b'', 'little')
     return result_dict
 
 
@@ -41,45 +50,174 @@ def unpack_completed_orders(completed_orders):
     ]
 
 
-def hours_intersect(working_h: List[str], delivery_h: List[str]) -> bool:
-    for working_h_step in working_h:
-        working_h_range = transform_to_dt(working_h_step)
-        for delivery_h_step in delivery_h:
-            delivery_h_range = transform_to_dt(delivery_h_step)
-            if working_h_range.is_overlapped(delivery_h_range):
-                return True
-    return False
-
-
-def transform_to_dt(bounds):
-    bounds_split = bounds.split('-')
-    time_range = TimeRange(time.strptime(bounds_split[0], '%H:%M'), time.strptime(bounds_split[1], '%H:%M'))
-    return time_range
-
-
-class TimeRange:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-
-    def is_overlapped(self, time_range):
-        if max(self.start, time_range.start) < min(self.end, time_range.end):
-            return True
-        else:
-            return False
+def prewarm_database(db_path, progress, extra_steps=0):
+    """Reads the hot tables through a separate connection to get their pages into the OS page cache.
+
+    Meant to be run in a worker thread, progress is a dict updated after every step. extra_steps are made
+    by the caller afterwards, they are only counted in progress['total_steps'].
+    """
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        steps = [('open orders', "SELECT count(*), sum(weight), sum(region), sum(courier_id) FROM orders "
+                                 "WHERE status != 2"),
+                 ('delivery hours', "SELECT count(*), sum(length(minutes_mask)) FROM delivery_hours"),
+                 ('couriers', "SELECT count(*), sum(length(type)) FROM couriers"),
+                 ('regions', "SELECT count(*), sum(region_id) FROM regions"),
+                 ('working hours', "SELECT count(*), sum(length(minutes_mask)) FROM working_hours")]
+        progress['total_steps'] = len(steps) + extra_steps
+        for step_number, (stage, query) in enumerate(steps):
+            progress['stage'] = stage
+            conn.execute(query).fetchall()
+            progress['completed_steps'] = step_number + 1
+    finally:
+        conn.close()
 
 
 class DatabaseConnector:
-    def __init__(self):
-        self.conn = sqlite3.connect('sweetdelivery.db')
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_path='sweetdelivery.db', read_only=False, wal=False):
+        # The connection is opened lazily (or by connect() on app startup), so that importing the app is cheap.
+        self.db_path = db_path
+        self.read_only = read_only
+        self.wal = wal
+        self._conn = None
+        self._cursor = None
+        # In WAL mode fetchall queries run in a separate thread on their own read-only connection, which sees committed
+        # data only. Otherwise its read lock would block the commits of the service, so they run on the main connection.
+        self.journal_mode = None
+        self.executor = None
+        self._reader = None
+        self._reader_query = None  # the query the reader is running, guarded by _reader_lock
+        self._reader_lock = threading.Lock()
         self.mutex = False
+        self.couriers_load = {'foot': 10, 'bike': 15, 'car': 50}
+        self.coefficient = {'foot': 2, 'bike': 5, 'car': 9}
+        # Monotonic counters of changes which may alter the result of assign_orders_to_courier: new or released
+        # orders in a region, changes of a courier's profile or of the set of his orders.
+        self.region_versions = defaultdict(int)
+        self.courier_versions = defaultdict(int)
+        self.assignments = {}  # courier_id: last computed assignment along with the versions it was computed at
+        self.assign_stats = {'computed': 0, 'skipped': 0}
+        self.index = RegionIndex()
+        # Read-only replica only: courier_id: last calculated rating with the data_version it was read at.
+        self.ratings = {}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.connect()
+        return self._conn
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self.connect()
+        profile = current_profile.get()
+        return self._cursor if profile is None else ProfilingCursor(self._cursor, profile)
+
+    def connect(self):
+        if self._conn is not None:
+            return
+        if self.read_only:
+            self._conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            self._conn.set_progress_handler(interrupt_expired_query, PROGRESS_HANDLER_INSTRUCTIONS)
+            self._cursor = self._conn.cursor()
+            if not self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+                raise RuntimeError(f'No tables found in {self.db_path}, the primary has to create them first.')
+            self.journal_mode = self.cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            return
+        self._conn = sqlite3.connect(self.db_path)
+        # Queries of a request which is past its deadline or whose client has gone are interrupted.
+        self._conn.set_progress_handler(interrupt_expired_query, PROGRESS_HANDLER_INSTRUCTIONS)
+        self._cursor = self._conn.cursor()
+        if self.wal:
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+        # The mode is kept in the database file, so it is WAL if an earlier run has switched it.
+        self.journal_mode = self.cursor.execute("PRAGMA journal_mode").fetchone()[0]
         tables = self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
         if len(tables) == 0:
             print("No tables found, creating.")
             self.create_tables()
-        self.couriers_load = {'foot': 10, 'bike': 15, 'car': 50}
-        self.coefficient = {'foot': 2, 'bike': 5, 'car': 9}
+        else:
+            self.upgrade_tables()
+
+    def region_index(self) -> RegionIndex:
+        if not self.index.built:
+            open_orders = self.cursor.execute("SELECT order_id, weight, region FROM orders WHERE status = 0").fetchall()
+            orders_masks = unpack_minutes_masks(self.cursor.execute(
+                "SELECT delivery_hours.order_id, delivery_hours.minutes_mask FROM delivery_hours "
+                "JOIN orders ON orders.order_id = delivery_hours.order_id WHERE orders.status = 0").fetchall())
+            couriers_regions = self.cursor.execute("SELECT courier_id, region_id FROM regions").fetchall()
+            self.index.build(open_orders, orders_masks, couriers_regions)
+        return self.index
+
+    def close(self):
+        if self._reader is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self._reader.close()
+            self._reader = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._cursor = None
+
+    async def fetchall(self, query):
+        """Runs a read-only query in the reader thread, so that the event loop keeps serving other requests
+        meanwhile. The query is interrupted when the request deadline passes or the client disconnects.
+
+        Without WAL the query runs on the main connection instead, where only the deadline is checked: a reader
+        holding its lock would make the commits of the service wait for it."""
+        check_deadline()
+        self.connect()  # the tables are created or upgraded by the main connection first
+        if self.journal_mode != 'wal':
+            return self.cursor.execute(query).fetchall()
+        if self._reader is None:
+            self._reader = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-reader')
+        token = object()
+
+        def execute():
+            with self._reader_lock:
+                self._reader_query = token
+            try:
+                cursor = self._reader.cursor()
+                profile = current_profile.get()
+                if profile is not None:
+                    cursor = ProfilingCursor(cursor, profile)
+                return cursor.execute(query).fetchall()
+            finally:
+                with self._reader_lock:
+                    self._reader_query = None
+
+        def interrupt():
+            # The reader may be running a query of another request already.
+            with self._reader_lock:
+                if self._reader_query is token:
+                    self._reader.interrupt()
+
+        loop = asyncio.get_event_loop()
+        # The profile of the request is a context variable, the query is run in the request context.
+        future = loop.run_in_executor(self.executor, contextvars.copy_context().run, execute)
+        deadline, timer = current_deadline.get(), None
+        if deadline is not None:
+            deadline.cancel_callbacks.add(interrupt)
+            if deadline.remaining() is not None:
+                timer = loop.call_later(deadline.remaining(), interrupt)
+        try:
+            return await future
+        finally:
+            if deadline is not None:
+                deadline.cancel_callbacks.discard(interrupt)
+            if timer is not None:
+                timer.cancel()
+
+    def abort(self):
+        """Rolls back the writes of a failed request, if it has left any, and forgets the state derived from them."""
+        self.mutex = False
+        if self._conn is not None and self._conn.in_transaction:
+            self._conn.rollback()
+            self.assignments.clear()
+            self.index.reset()
 
     def create_tables(self):
         self.cursor.execute(
@@ -87,9 +225,11 @@ class DatabaseConnector:
         self.cursor.execute(
             "CREATE TABLE regions (region_id INTEGER, courier_id INTEGER);"),
         self.cursor.execute(
-            "CREATE TABLE working_hours (courier_id INTEGER, working_hours VARCHAR(20));")
+            "CREATE TABLE working_hours (courier_id INTEGER, working_hours VARCHAR(20), "
+            "minutes_mask BLOB);")
         self.cursor.execute(
-            "CREATE TABLE delivery_hours (order_id INTEGER, delivery_hours VARCHAR(20));")
+            "CREATE TABLE delivery_hours (order_id INTEGER, delivery_hours VARCHAR(20), "
+            "minutes_mask BLOB);")
         self.cursor.execute("""
               CREATE TABLE orders (order_id INTEGER PRIMARY KEY, 
                                    weight FLOAT, 
@@ -101,6 +241,45 @@ class DatabaseConnector:
                                    courier_id INTEGER,
                                    type_when_assigned VARCHAR(5));
               """)
+        self.create_archive_tables()
+        self.conn.commit()
+
+    def create_archive_tables(self):
+        # Completed orders are moved here by archive_completed_orders to keep the 'orders' table small.
+        self.cursor.execute("""
+              CREATE TABLE IF NOT EXISTS orders_archive (order_id INTEGER PRIMARY KEY, 
+                                                         weight FLOAT, 
+                                                         region INTEGER, 
+                                                         status INTEGER,
+                                                         date_created DATETIME,
+                                                         date_assigned DATETIME,
+                                                         date_finished DATETIME,
+                                                         courier_id INTEGER,
+                                                         type_when_assigned VARCHAR(5));
+              """)
+        # Ids of archived orders stay taken.
+        self.cursor.execute("""
+              CREATE TRIGGER IF NOT EXISTS orders_archived_id BEFORE INSERT ON orders
+              WHEN EXISTS (SELECT 1 FROM orders_archive WHERE order_id = NEW.order_id)
+              BEGIN SELECT RAISE(ABORT, 'UNIQUE constraint failed: orders.order_id'); END;
+              """)
+
+    def upgrade_tables(self):
+        # Databases created by older versions store time intervals as strings only.
+        for table in ('working_hours', 'delivery_hours'):
+            columns = [column[1] for column in self.cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+            if 'minutes_mask' not in columns:
+                print(f"Adding minutes bitmaps to '{table}' table.")
+                self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN minutes_mask BLOB")
+                for rowid, time_str in self.cursor.execute(f"SELECT rowid, {table} FROM {table}").fetchall():
+                    try:
+                        mask = parse_time_intervals([time_str])[0].mask
+                    except ValueError:
+                        # Malformed legacy value: store an empty mask so that it never intersects anything.
+                        print(f"Malformed time interval '{time_str}' in '{table}' table, rowid = {rowid}.")
+                        mask = 0
+                    self.cursor.execute(f"UPDATE {table} SET minutes_mask = {mask_to_sql(mask)} WHERE rowid = {rowid}")
+        self.create_archive_tables()
         self.conn.commit()
 
     async def insert_couriers(self, couriers: List[Courier]):
@@ -113,13 +292,17 @@ class DatabaseConnector:
                     f"INSERT INTO regions(region_id, courier_id) VALUES ({region}, {courier.courier_id});")
             for working_hours_ in courier.working_hours:
                 self.cursor.execute(
-                    "INSERT INTO working_hours(courier_id, working_hours) "
-                    f"VALUES ({courier.courier_id}, '{working_hours_}');")
+                    "INSERT INTO working_hours(courier_id, working_hours, minutes_mask) "
+                    f"VALUES ({courier.courier_id}, '{working_hours_}', {mask_to_sql(working_hours_.mask)});")
         self.mutex = False
         self.conn.commit()
+        for courier in couriers:
+            self.index.set_courier_regions(courier.courier_id, courier.regions)
 
     async def insert_orders(self, orders: List[Order]):
         self.mutex = True
+        for region in {order.region for order in orders}:
+            self.region_versions[region] += 1
         for order in orders:
             # in orders table 'status' column has three possible values:
             # 0 - order is not assigned, 1 - order is assigned, 2 - order is completed
@@ -130,53 +313,87 @@ class DatabaseConnector:
                     f"0, '{datetime.utcnow().isoformat()[:-3] + 'Z'}');")
             except sqlite3.IntegrityError:
                 self.mutex = False
+                self.index.reset()
                 raise sqlite3.IntegrityError(f'Order with id = {order.order_id} already exists')
             for delivery_hours_ in order.delivery_hours:
                 self.cursor.execute(
-                    "INSERT INTO delivery_hours(order_id, delivery_hours) "
-                    f"VALUES ({order.order_id}, '{delivery_hours_}');")
+                    "INSERT INTO delivery_hours(order_id, delivery_hours, minutes_mask) "
+                    f"VALUES ({order.order_id}, '{delivery_hours_}', {mask_to_sql(delivery_hours_.mask)});")
         self.mutex = False
         self.conn.commit()
+        for order in orders:
+            mask = 0
+            for delivery_hours_ in order.delivery_hours:
+                mask |= delivery_hours_.mask
+            self.index.add_order(order.order_id, order.weight, order.region, mask)
+
+    async def find_couriers_for_orders(self, courier_ids: List[int], orders: List[Order]) -> List[int]:
+        """Returns those of courier_ids who work in the region and at the delivery time of any of the orders."""
+        if len(courier_ids) == 0 or len(orders) == 0:
+            return []
+        while self.mutex:
+            await asyncio.sleep(0.1)
+        orders_hours = {}  # region: minutes mask of the delivery hours of all the orders in the region
+        for order in orders:
+            for interval in order.delivery_hours:
+                orders_hours[order.region] = orders_hours.get(order.region, 0) | interval.mask
+        index = self.region_index()
+        courier_ids = index.couriers_in(orders_hours) & set(courier_ids)
+        if len(courier_ids) == 0:
+            return []
+        courier_ids_tuple = tuple(courier_ids)
+        courier_ids_tuple = str(courier_ids_tuple)[:-2] + ')' if len(courier_ids_tuple) == 1 else str(courier_ids_tuple)
+        working_hours = unpack_minutes_masks(self.cursor.execute("SELECT courier_id, minutes_mask FROM working_hours "
+                                                                 f"WHERE courier_id IN {courier_ids_tuple}").fetchall())
+        return sorted(courier_id for courier_id in courier_ids
+                      if any(working_hours.get(courier_id, 0) & orders_hours[region]
+                             for region in index.courier_regions[courier_id] if region in orders_hours))
+
+    def is_assignment_actual(self, courier_id, assignment):
+        return assignment['courier_version'] == self.courier_versions[courier_id] and \
+            all(self.region_versions[region] == version for region, version in assignment['region_versions'].items())
 
     async def assign_orders_to_courier(self, courier_id):
+        """Returns ids of all the orders assigned to the courier, their assign time and ids of the newly assigned ones."""
+        assignment = self.assignments.get(courier_id)
+        if assignment is not None and self.is_assignment_actual(courier_id, assignment):
+            self.assign_stats['skipped'] += 1
+            return assignment['orders'], assignment['assign_time'], []
+        self.assign_stats['computed'] += 1
         courier_type, courier_max_load, courier_regions, courier_working_hours, courier_current_orders = \
             await self.get_actual_courier_status(courier_id)
-        courier_rest_load = courier_max_load - sum(courier_current_orders.values())
-        regions_tuple = str(courier_regions)[:-2] + ')' if len(courier_regions) == 1 else str(courier_regions)
-        possible_orders = unpack_orders(self.cursor.execute(
-            "SELECT order_id, weight FROM orders "
-            "WHERE status = 0 "
-            f"AND region IN {regions_tuple} ").fetchall())  # possible_orders = {id: weight}
-        if len(possible_orders) == 0:
-            return [], None
-        order_ids_tuple = tuple(possible_orders.keys())
-        order_ids_tuple = str(order_ids_tuple)[:-2] + ')' if len(order_ids_tuple) == 1 else str(order_ids_tuple)
+        # Nothing is awaited from here on, so the versions correspond to the data read below.
+        assignment = {'courier_version': self.courier_versions[courier_id],
+                      'region_versions': {region: self.region_versions[region] for region in courier_regions}}
+        valid_orders = await self.find_orders_for_courier(courier_id, courier_type, courier_max_load, courier_regions,
+                                                          courier_working_hours, courier_current_orders)
+        order_ids = list(courier_current_orders.keys()) + valid_orders
+        dt = None
+        if order_ids:
+            dt = self.cursor.execute("SELECT min(date_assigned) FROM orders "
+                                     f"WHERE courier_id = {courier_id} AND status = 1 ").fetchone()[0]
+        assignment.update(orders=order_ids, assign_time=dt)
+        self.assignments[courier_id] = assignment
+        return order_ids, dt, valid_orders
 
-        delivery_time = unpack_delivery_hours(
-            self.cursor.execute("SELECT order_id, delivery_hours FROM delivery_hours "
-                                f"WHERE order_id IN {order_ids_tuple} "
-                                ).fetchall())
-        possible_orders_timefiltered = {}
-        for possible_order in possible_orders:
-            if hours_intersect(courier_working_hours, delivery_time[possible_order]):
-                possible_orders_timefiltered[possible_order] = possible_orders[possible_order]
-
-        # выбрать по подходящему весу, назначить куре
-        if len(possible_orders_timefiltered) == 0:
-            return [], None
-        # Sort orders by weight to give courier the maximum number of orders
-        possible_orders_timefiltered = dict(sorted(possible_orders_timefiltered.items(), key=lambda item: item[1]))
+    async def find_orders_for_courier(self, courier_id, courier_type, courier_max_load, courier_regions,
+                                      courier_working_hours, courier_current_orders):
+        """Assigns the suitable unassigned orders to the courier, returns their ids."""
+        courier_rest_load = courier_max_load - sum(courier_current_orders.values())
+        index = self.region_index()
         valid_orders = []
-        for order in possible_orders_timefiltered:
-            delta = courier_rest_load - possible_orders_timefiltered[order]
-            if delta < 0:
-                break
-            else:
-                valid_orders.append(order)
-                courier_rest_load = delta
-        dt = None
+        with stage('packing'):
+            # Orders are taken lightest first to give courier the maximum number of orders, the first one which does
+            # not fit means that the heavier ones do not fit either.
+            for order, weight in index.lightest_orders(courier_regions, courier_working_hours):
+                delta = courier_rest_load - weight
+                if delta < 0:
+                    break
+                else:
+                    valid_orders.append(order)
+                    courier_rest_load = delta
         if not valid_orders:
-            return [], dt
+            return []
         self.mutex = True
         dt = datetime.utcnow().isoformat()[:-3] + 'Z'
         for valid_order in valid_orders:
@@ -184,12 +401,9 @@ class DatabaseConnector:
                                 f"type_when_assigned = '{courier_type}' "
                                 f"WHERE order_id = {valid_order}")
         self.conn.commit()
+        self.index.remove_orders(valid_orders)
         self.mutex = False
-        if len(courier_current_orders):
-            valid_orders = list(courier_current_orders.keys()) + valid_orders
-            dt = self.cursor.execute("SELECT min(date_assigned) FROM orders "
-                                     f"WHERE courier_id = {courier_id} AND status = 1 ").fetchone()[0]
-        return valid_orders, dt
+        return valid_orders
 
     async def patch_courier(self, courier_id, patch):
         patch_keys = list(patch.keys())
@@ -206,12 +420,14 @@ class DatabaseConnector:
             for region in patch['regions']:
                 self.cursor.execute(
                     f"INSERT INTO regions(region_id, courier_id) VALUES ({region}, {courier_id});")
+            self.index.set_courier_regions(courier_id, patch['regions'])
         if 'working_hours' in patch_keys:
             self.cursor.execute(f"DELETE FROM working_hours WHERE courier_id = {courier_id}")
             for working_hours_ in patch['working_hours']:
                 self.cursor.execute(
-                    "INSERT INTO working_hours(courier_id, working_hours) "
-                    f"VALUES ({courier_id}, '{working_hours_}');")
+                    "INSERT INTO working_hours(courier_id, working_hours, minutes_mask) "
+                    f"VALUES ({courier_id}, '{working_hours_}', {mask_to_sql(working_hours_.mask)});")
+        self.courier_versions[courier_id] += 1
         self.conn.commit()
         self.mutex = False
         await self.validate_existing_orders(courier_id, patch_keys)
@@ -230,7 +446,8 @@ class DatabaseConnector:
                 invalid_regions = str(invalid_regions)[:-2] + ')' if len(invalid_regions) == 1 else str(invalid_regions)
                 invalid_ids = unpack_list_to_list(self.cursor.execute("SELECT order_id FROM orders "
                                                                       f"WHERE region IN {invalid_regions} "
-                                                                      f"AND courier_id = {courier_id}").fetchall())
+                                                                      f"AND courier_id = {courier_id} "
+                                                                      "AND status = 1").fetchall())
                 self.mutex = True
                 for invalid_id in invalid_ids:
                     courier_current_orders.pop(invalid_id)
@@ -238,19 +455,21 @@ class DatabaseConnector:
                         f"UPDATE orders SET status = 0, date_assigned = null, courier_id = null, "
                         f"type_when_assigned = null "
                         f"WHERE order_id = {invalid_id}")
+                self.release_orders_versions(courier_id, invalid_ids)
                 self.conn.commit()
                 self.mutex = False
         if ('working_hours' in changed_fields) and (len(courier_current_orders) > 0):
             order_ids_tuple = tuple(courier_current_orders.keys())
             order_ids_tuple = str(order_ids_tuple)[:-2] + ')' if len(order_ids_tuple) == 1 else str(order_ids_tuple)
-            delivery_time = unpack_delivery_hours(
-                self.cursor.execute("SELECT order_id, delivery_hours FROM delivery_hours "
+            delivery_time = unpack_minutes_masks(
+                self.cursor.execute("SELECT order_id, minutes_mask FROM delivery_hours "
                                     f"WHERE order_id IN {order_ids_tuple} "
                                     ).fetchall())
             invalid_orders = []
-            for order in courier_current_orders:
-                if not hours_intersect(courier_working_hours, delivery_time[order]):
-                    invalid_orders.append(order)
+            with stage('hours_intersect'):
+                for order in courier_current_orders:
+                    if not courier_working_hours & delivery_time.get(order, 0):
+                        invalid_orders.append(order)
             self.mutex = True
             for invalid_id in invalid_orders:
                 courier_current_orders.pop(invalid_id)
@@ -258,6 +477,7 @@ class DatabaseConnector:
                     f"UPDATE orders SET status = 0, date_assigned = null, courier_id = null, "
                     f"type_when_assigned = null "
                     f"WHERE order_id = {invalid_id}")
+            self.release_orders_versions(courier_id, invalid_orders)
             self.conn.commit()
             self.mutex = False
 
@@ -268,18 +488,37 @@ class DatabaseConnector:
                 courier_current_orders = dict(
                     reversed(sorted(courier_current_orders.items(), key=lambda item: item[1])))
                 for order_id, order_weight in courier_current_orders.items():
-                    delta = courier_rest_load + order_weight
+                    courier_rest_load += order_weight
                     dropped_orders.append(order_id)
-                    if delta >= 0:
+                    if courier_rest_load >= 0:
                         break
+                self.mutex = True
                 for dropped_id in dropped_orders:
                     self.cursor.execute(
                         f"UPDATE orders SET status = 0, date_assigned = null, courier_id = null, "
                         f"type_when_assigned = null "
                         f"WHERE order_id = {dropped_id}")
+                self.release_orders_versions(courier_id, dropped_orders)
                 self.conn.commit()
                 self.mutex = False
 
+    def release_orders_versions(self, courier_id, order_ids):
+        # Released orders become available to other couriers in their regions.
+        if len(order_ids) == 0:
+            return
+        self.courier_versions[courier_id] += 1
+        order_ids_tuple = tuple(order_ids)
+        order_ids_tuple = str(order_ids_tuple)[:-2] + ')' if len(order_ids_tuple) == 1 else str(order_ids_tuple)
+        released_orders = self.cursor.execute("SELECT order_id, weight, region FROM orders "
+                                              f"WHERE order_id IN {order_ids_tuple}").fetchall()
+        for region in {region for _, _, region in released_orders}:
+            self.region_versions[region] += 1
+        if self.index.built:
+            masks = unpack_minutes_masks(self.cursor.execute("SELECT order_id, minutes_mask FROM delivery_hours "
+                                                             f"WHERE order_id IN {order_ids_tuple}").fetchall())
+            for order_id, weight, region in released_orders:
+                self.index.add_order(order_id, weight, region, masks.get(order_id, 0))
+
     async def get_actual_courier_status(self, courier_id: int):
         while self.mutex:
             await asyncio.sleep(0.1)
@@ -290,8 +529,10 @@ class DatabaseConnector:
         courier_max_load = self.couriers_load[courier_type]
         courier_regions = unpack_list(self.cursor.execute("SELECT region_id FROM regions "
                                                           f"WHERE courier_id = {courier_id}").fetchall())
-        courier_working_hours = unpack_list_to_list(self.cursor.execute("SELECT working_hours FROM working_hours "
-                                                                        f"WHERE courier_id = {courier_id}").fetchall())
+        courier_working_hours = unpack_minutes_masks(self.cursor.execute("SELECT courier_id, minutes_mask "
+                                                                         "FROM working_hours "
+                                                                         f"WHERE courier_id = {courier_id}").fetchall()
+                                                     ).get(courier_id, 0)
         courier_current_orders = unpack_orders(self.cursor.execute("SELECT order_id, weight FROM orders "
                                                                    f"WHERE courier_id = {courier_id} "
                                                                    "AND status = 1").fetchall())
@@ -319,6 +560,9 @@ class DatabaseConnector:
         try:
             order = self.cursor.execute("SELECT order_id, status, courier_id FROM orders "
                                         f"WHERE order_id = {completed_order.order_id} ").fetchone()
+            if not order:
+                order = self.cursor.execute("SELECT order_id, status, courier_id FROM orders_archive "
+                                            f"WHERE order_id = {completed_order.order_id} ").fetchone()
             if not order:
                 raise TypeError(f'No order with id {completed_order.order_id} found')
         except TypeError:
@@ -336,38 +580,66 @@ class DatabaseConnector:
             self.mutex = True
             self.cursor.execute(f"UPDATE orders SET status = 2, date_finished = '{completed_order.complete_time}' "
                                 f"WHERE order_id = {completed_order.order_id}")
+            self.courier_versions[completed_order.courier_id] += 1
             self.conn.commit()
             self.mutex = False
             return completed_order.order_id
 
+    async def archive_completed_orders(self, older_than: timedelta, batch_size: int) -> int:
+        """Moves up to batch_size orders completed more than older_than ago to the archive, returns their number."""
+        while self.mutex:
+            await asyncio.sleep(0.1)
+        finished_before = (datetime.utcnow() - older_than).strftime(DATETIME_FORMAT)[:-4] + 'Z'
+        order_ids = unpack_list(self.cursor.execute("SELECT order_id FROM orders "
+                                                    f"WHERE status = 2 AND date_finished < '{finished_before}' "
+                                                    f"LIMIT {batch_size}").fetchall())
+        if len(order_ids) == 0:
+            return 0
+        order_ids_tuple = str(order_ids)[:-2] + ')' if len(order_ids) == 1 else str(order_ids)
+        self.mutex = True
+        self.cursor.execute(f"INSERT INTO orders_archive SELECT * FROM orders WHERE order_id IN {order_ids_tuple}")
+        self.cursor.execute(f"DELETE FROM orders WHERE order_id IN {order_ids_tuple}")
+        # Delivery hours of completed orders are never needed again.
+        self.cursor.execute(f"DELETE FROM delivery_hours WHERE order_id IN {order_ids_tuple}")
+        self.conn.commit()
+        self.mutex = False
+        return len(order_ids)
+
     async def calculate_couriers_rating(self, courier_id):
         courier_data = await self.get_courier_data(courier_id)
         earnings = 0
         courier_data["earnings"] = earnings
-        completed_orders = unpack_completed_orders(self.cursor.execute(
+        # Archived orders are all completed, so they take part in both rating and earnings.
+        completed_orders = await self.fetchall(
             "SELECT order_id, region, date_assigned, date_finished, type_when_assigned "
             f"FROM orders WHERE courier_id = {courier_id} AND status = 2 "
-            "ORDER BY date_finished DESC ").fetchall())
+            "UNION ALL "
+            "SELECT order_id, region, date_assigned, date_finished, type_when_assigned "
+            f"FROM orders_archive WHERE courier_id = {courier_id} "
+            "ORDER BY date_finished DESC ")
 
         # Deliveries calculation
 
-        assigned_orders = unpack_completed_orders(self.cursor.execute(
+        assigned_orders = await self.fetchall(
             "SELECT order_id, region, date_assigned, date_finished, type_when_assigned "
             f"FROM orders WHERE courier_id = {courier_id} AND status != 0 "
-            "ORDER BY date_assigned DESC ").fetchall())
-
-        all_assign_dates = []
-        for order in assigned_orders:
-            all_assign_dates.append(order['date_assigned'])
+            "UNION ALL "
+            "SELECT order_id, region, date_assigned, date_finished, type_when_assigned "
+            f"FROM orders_archive WHERE courier_id = {courier_id} "
+            "ORDER BY date_assigned DESC ")
+        with stage('strptime'):
+            completed_orders = unpack_completed_orders(completed_orders)
+            assigned_orders = unpack_completed_orders(assigned_orders)
 
         deliveries_types = []
-        for assign_date in set({order['date_assigned'] for order in assigned_orders}):
-            temp = []
-            for order in assigned_orders:
-                if order['date_assigned'] == assign_date:
-                    temp.append(order)
-            if all(order['date_finished'] for order in temp):
-                deliveries_types.append(temp[0]['type_when_assigned'])
+        with stage('earnings loop'):
+            for assign_date in set({order['date_assigned'] for order in assigned_orders}):
+                temp = []
+                for order in assigned_orders:
+                    if order['date_assigned'] == assign_date:
+                        temp.append(order)
+                if all(order['date_finished'] for order in temp):
+                    deliveries_types.append(temp[0]['type_when_assigned'])
         if not len(deliveries_types):
             return courier_data
         for delivery_type in deliveries_types:
@@ -376,20 +648,44 @@ class DatabaseConnector:
 
         # Rating calculation
         average_time = []
-        for i, order in enumerate(completed_orders[:-1]):
-            order['delivery_time'] = (order['date_finished'] - completed_orders[i + 1]['date_finished']).total_seconds()
-        completed_orders[-1]['delivery_time'] = \
-            (completed_orders[-1]['date_finished'] - completed_orders[-1]['date_assigned']).total_seconds()
-        for region in courier_data['regions']:
-            temp_sum = 0
-            temp_number = 0
-            for order in completed_orders:
-                if order['region'] == region:
-                    temp_sum += order['delivery_time']
-                    temp_number += 1
-            if temp_number != 0:
-                average_time.append(temp_sum / temp_number)
+        with stage('rating loop'):
+            for i, order in enumerate(completed_orders[:-1]):
+                order['delivery_time'] = \
+                    (order['date_finished'] - completed_orders[i + 1]['date_finished']).total_seconds()
+            completed_orders[-1]['delivery_time'] = \
+                (completed_orders[-1]['date_finished'] - completed_orders[-1]['date_assigned']).total_seconds()
+            for region in courier_data['regions']:
+                temp_sum = 0
+                temp_number = 0
+                for order in completed_orders:
+                    if order['region'] == region:
+                        temp_sum += order['delivery_time']
+                        temp_number += 1
+                if temp_number != 0:
+                    average_time.append(temp_sum / temp_number)
+        if not average_time:
+            # Orders were completed only in regions the courier does not work in anymore.
+            return courier_data
         t = min(average_time)
         courier_data["rating"] = round(((60 * 60 - min(t, 60 * 60)) / (60 * 60) * 5), 2)
 
         return courier_data
+
+    async def get_replica_courier_rating(self, courier_id, max_staleness):
+        """Rating for a read-only replica, along with an upper bound of its staleness in seconds.
+
+        PRAGMA data_version changes whenever the primary commits, until then a cached rating is exact. After a commit
+        the cached rating is still served for max_staleness seconds since it was calculated.
+        """
+        data_version = self.cursor.execute("PRAGMA data_version").fetchone()[0]
+        cached = self.ratings.get(courier_id)
+        now = time.monotonic()
+        if cached is not None:
+            if cached['data_version'] == data_version:
+                cached['calculated_at'] = now
+                return dict(cached['rating']), 0.0
+            if now - cached['calculated_at'] <= max_staleness:
+                return dict(cached['rating']), now - cached['calculated_at']
+        rating = await self.calculate_couriers_rating(courier_id)
+        self.ratings[courier_id] = {'data_version': data_version, 'calculated_at': now, 'rating': rating}
+        return dict(rating), 0.0